@@ -7,6 +7,10 @@
 
 """Parse SQL statements."""
 
+import pickle
+import threading
+from collections import OrderedDict
+
 # Setup namespace
 from bsqlparse import sql
 from bsqlparse import cli
@@ -20,15 +24,104 @@ from bsqlparse.compat import text_type
 __version__ = '0.2.3'
 __all__ = ['engine', 'filters', 'formatter', 'sql', 'tokens', 'cli']
 
+# Cache used by parse(), None unless enable_parse_cache() was called.
+_parse_cache = None
+
+
+class _ParseCache(object):
+    """Pickled results of parse() by (sql, encoding).
+
+    Unpickling gives a new tree on each hit and is an order of magnitude
+    faster than parsing again. The least recently used results are
+    dropped when the pickles take more than *maxbytes* in total.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._blobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            blob = self._blobs.pop(key, None)
+            if blob is not None:
+                # move to the end, there's no move_to_end() on Python 2
+                self._blobs[key] = blob
+        return blob
+
+    def put(self, key, blob):
+        if len(blob) > self.maxbytes:
+            return
+        with self._lock:
+            old = self._blobs.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._blobs[key] = blob
+            self.nbytes += len(blob)
+            while self.nbytes > self.maxbytes:
+                _, dropped = self._blobs.popitem(last=False)
+                self.nbytes -= len(dropped)
+
+    def clear(self):
+        with self._lock:
+            self._blobs.clear()
+            self.nbytes = 0
+
+
+def enable_parse_cache(maxbytes=32 * 1024 * 1024):
+    """Make :func:`parse` cache its results.
+
+    Strings parsed again are unpickled from the cache instead of being
+    parsed, each call still gets a tree of its own. A pickled result
+    takes about 25 times the size of its SQL. The least recently used
+    results are dropped when they take more than *maxbytes* in total.
+    Calling this again starts over with an empty cache.
+
+    :param maxbytes: Size limit of the cached results in bytes.
+    """
+    global _parse_cache
+    _parse_cache = _ParseCache(maxbytes)
+
+
+def disable_parse_cache():
+    """Stop caching results of :func:`parse` and drop the cached ones."""
+    global _parse_cache
+    _parse_cache = None
+
+
+def clear_parse_cache():
+    """Drop the results cached by :func:`parse`."""
+    cache = _parse_cache
+    if cache is not None:
+        cache.clear()
+
 
 def parse(sql, encoding=None):
     """Parse sql and return a list of statements.
 
+    Results are cached if :func:`enable_parse_cache` was called.
+
     :param sql: A string containing one or more SQL statements.
     :param encoding: The encoding of the statement (optional).
     :returns: A tuple of :class:`~bsqlparse.sql.Statement` instances.
     """
-    return tuple(parsestream(sql, encoding))
+    cache = _parse_cache
+    if cache is None or not isinstance(sql, (text_type, bytes)):
+        return tuple(parsestream(sql, encoding))
+
+    key = sql, encoding
+    blob = cache.get(key)
+    if blob is not None:
+        return pickle.loads(blob)
+    stmts = tuple(parsestream(sql, encoding))
+    try:
+        blob = pickle.dumps(stmts, pickle.HIGHEST_PROTOCOL)
+    except RuntimeError:
+        # nested too deep for pickle's recursion (RecursionError)
+        return stmts
+    cache.put(key, blob)
+    return stmts
 
 
 def parsestream(stream, encoding=None):
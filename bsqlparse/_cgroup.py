@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# cython: language_level=3str
+#
+# Copyright (C) 2016 Andi Albrecht, albrecht.andi@gmail.com
+#
+# This module is part of python-bsqlparse and is released under
+# the BSD License: https://opensource.org/licenses/BSD-3-Clause
+
+"""Tree walks used by the classes in bsqlparse.sql.
+
+This module doesn't import bsqlparse.sql, the group classes are passed
+in, so it can be compiled with Cython or mypyc on its own (see setup.py).
+"""
+
+MYPY = False
+if MYPY:  # pragma: no cover
+    from typing import Any, Callable, Iterable, List, Set  # noqa
+
+
+def collect_functions(groups, function_cls, identifier_cls, container_cls,
+                      get_names):
+    # type: (Iterable[Any], Any, Any, Any, Callable[[], Any]) -> List[Any]
+    """Returns the called functions found in and below *groups*.
+
+    A function wrapped in an identifier (e.g. ``pkg.f(x)``) is returned
+    as the identifier. Other functions are returned only if their name is
+    in ``get_names()``, which is called at most once. Identifiers directly
+    within a *container_cls* group are returned too.
+
+    The groups are walked depth-first with an explicit stack, each
+    result is listed once in the order it is found.
+    """
+    found_list = []  # type: List[Any]
+    seen = set()  # type: Set[int]
+    names = None  # type: Any
+    stack = list(groups)
+    stack.reverse()
+    while stack:
+        group = stack.pop()
+        found = None  # type: Any
+        if isinstance(group, function_cls):
+            if isinstance(group.parent, identifier_cls):
+                found = group.parent
+            else:
+                if names is None:
+                    names = get_names()
+                if group.name in names:
+                    found = group
+        elif (isinstance(group, identifier_cls)
+              and isinstance(group.parent, container_cls)):
+            found = group
+        if found is not None and id(found) not in seen:
+            seen.add(id(found))
+            found_list.append(found)
+        sublists = [token for token in group.tokens if token.is_group]
+        sublists.reverse()
+        stack.extend(sublists)
+    return found_list
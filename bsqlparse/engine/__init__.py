@@ -5,12 +5,41 @@
 # This module is part of python-bsqlparse and is released under
 # the BSD License: https://opensource.org/licenses/BSD-3-Clause
 
-from bsqlparse.engine import grouping
-from bsqlparse.engine.filter_stack import FilterStack
-from bsqlparse.engine.statement_splitter import StatementSplitter
+import importlib
+import sys
 
-__all__ = [
-    'grouping',
+# Resolved on first access (PEP 562), e.g. using only the
+# StatementSplitter doesn't import the grouping machinery.
+# The grouping submodules are not re-exported, import them explicitly
+# (``from bsqlparse.engine import grouping``).
+_LAZY = {
+    'FilterStack': 'bsqlparse.engine.filter_stack',
+    'StatementSplitter': 'bsqlparse.engine.statement_splitter',
+}
+
+__all__ = (
     'FilterStack',
     'StatementSplitter',
-]
+)
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY[name]
+    except KeyError:
+        raise AttributeError(
+            'module {0!r} has no attribute {1!r}'.format(__name__, name))
+    obj = getattr(importlib.import_module(module), name)
+    globals()[name] = obj
+    return obj
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+
+# Module level __getattr__ is only honoured by Python 3.7+.
+if sys.version_info < (3, 7):
+    for _name in __all__:
+        __getattr__(_name)
+    del _name
@@ -7,6 +7,15 @@
 
 """filter"""
 
+import copy
+import itertools
+import pickle
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ProcessPoolExecutor = None
+
 from bsqlparse import lexer
 from bsqlparse.engine import grouping, grouping_class
 from bsqlparse.engine.statement_splitter import StatementSplitter
@@ -23,6 +32,13 @@ class FilterStack(object):
         self._grouping = True
 
     def run(self, sql, encoding=None):
+        # Statements are yielded one by one as soon as their filters ran.
+        # The filter lists are bound once instead of per statement.
+        stmtprocess = tuple(self.stmtprocess)
+        postprocess = tuple(self.postprocess)
+        # grouping keeps no state between statements, one is enough
+        gc = grouping_class.grouping() if self._grouping else None
+
         stream = lexer.tokenize(sql, encoding)
         # Process token stream
         for filter_ in self.preprocess:
@@ -32,15 +48,92 @@ class FilterStack(object):
 
         # Output: Stream processed Statements
         for stmt in stream:
-            if self._grouping:
-                gc = grouping_class.grouping()
+            if gc is not None:
                 # stmt = grouping.group(stmt)
                 stmt = gc.group(stmt)
 
-            for filter_ in self.stmtprocess:
+            for filter_ in stmtprocess:
                 filter_.process(stmt)
 
-            for filter_ in self.postprocess:
+            for filter_ in postprocess:
                 stmt = filter_.process(stmt)
 
             yield stmt
+
+    def run_many(self, sqls, encoding=None, workers=1, chunksize=1):
+        """Runs the stack on each SQL source in *sqls*.
+
+        Yields a tuple of the processed statements per source, in the
+        order of *sqls*. Each source is processed with fresh copies of
+        the filters, so filters keeping state between statements (like
+        the reindent filter) start over for every source.
+
+        If *workers* is greater than 1 the sources are processed in a
+        pool of that many processes, sent to the workers in batches of
+        *chunksize* sources. The filters must be picklable then. A result
+        too deeply nested to be pickled is processed again in this
+        process. Without concurrent.futures (Python 2 without the futures
+        backport) the sources are always processed here.
+        """
+        if workers <= 1 or ProcessPoolExecutor is None:
+            for sql in sqls:
+                yield _run(self._copy(), sql, encoding)
+            return
+
+        sqls = list(sqls)
+        chunks = [sqls[i:i + chunksize]
+                  for i in range(0, len(sqls), chunksize)]
+        with ProcessPoolExecutor(workers) as executor:
+            results = executor.map(_run_chunk, itertools.repeat(self),
+                                   chunks, itertools.repeat(encoding))
+            for chunk, blobs in zip(chunks, results):
+                for sql, blob in zip(chunk, blobs):
+                    stmts = _loads(blob)
+                    if stmts is None:
+                        stmts = _run(self._copy(), sql, encoding)
+                    yield stmts
+
+    def _copy(self):
+        """Returns a copy of the stack with copies of its filters.
+
+        The filters keep their state in plain attributes, which are
+        replaced, not modified, so shallow copies are enough.
+        """
+        stack = copy.copy(self)
+        stack.preprocess = [copy.copy(f) for f in self.preprocess]
+        stack.stmtprocess = [copy.copy(f) for f in self.stmtprocess]
+        stack.postprocess = [copy.copy(f) for f in self.postprocess]
+        return stack
+
+
+def _run(stack, sql, encoding):
+    """Runs *stack* on *sql*."""
+    return tuple(stack.run(sql, encoding))
+
+
+def _run_chunk(stack, sqls, encoding):
+    """Runs *stack* on each of *sqls* in a worker process.
+
+    Returns the pickled statements per source, or ``None`` for results
+    nested too deep for pickle.
+    """
+    blobs = []
+    for sql in sqls:
+        try:
+            blob = pickle.dumps(_run(stack._copy(), sql, encoding),
+                                pickle.HIGHEST_PROTOCOL)
+        except RuntimeError:
+            # RecursionError, pickle recurses once per tree level
+            blob = None
+        blobs.append(blob)
+    return blobs
+
+
+def _loads(blob):
+    """Returns the statements pickled by _run_chunk() or ``None``."""
+    if blob is None:
+        return None
+    try:
+        return pickle.loads(blob)
+    except RuntimeError:
+        return None
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+# cython: language_level=3str
 #
 # Copyright (C) 2016 Andi Albrecht, albrecht.andi@gmail.com
 #
@@ -7,54 +8,278 @@
 
 from bsqlparse import sql
 from bsqlparse import tokens as T
-from bsqlparse.utils import recurse, imt
+from bsqlparse.compat import string_types
+from bsqlparse.utils import recurse, imt, imt_predicate
 
 T_NUMERICAL = (T.Number, T.Number.Integer, T.Number.Float)
 T_STRING = (T.String, T.String.Single, T.String.Symbol)
 T_NAME = (T.Name, T.Name.Placeholder)
 
+# Operands of the group_* passes, built once instead of on every call
+_PERIOD_PREV_SQLCLS = (sql.SquareBrackets, sql.Identifier, sql.Function)
+_PERIOD_PREV_TTYPES = frozenset((T.Name, T.String.Symbol))
+_PERIOD_NEXT_SQLCLS = (sql.SquareBrackets, sql.Function)
+_PERIOD_NEXT_TTYPES = frozenset((T.Name, T.String.Symbol, T.Wildcard))
+_AS_NEXT_TTYPES = (T.DML, T.DDL)
+_CMP_SQLCLS = (sql.Parenthesis, sql.Function, sql.Identifier, sql.Operation,
+               sql.NotFound)
+_CMP_TTYPES = frozenset(T_NUMERICAL + T_STRING + T_NAME
+                        + (T.Keyword, T.Name.Builtin, T.Name.Negative))
+_IDENT_TTYPES = (T.String.Symbol, T.Name)
+_ARRAY_SQLCLS = (sql.SquareBrackets, sql.Identifier, sql.Function)
+_ARRAY_TTYPES = frozenset((T.Name, T.String.Symbol))
+_OP_SQLCLS = (sql.SquareBrackets, sql.Parenthesis, sql.Function,
+              sql.Identifier, sql.Operation)
+_OP_TTYPES = frozenset(T_NUMERICAL + T_STRING + T_NAME)
+_OP_MATCH_TTYPES = frozenset((T.Operator, T.Wildcard))
+_LIST_SQLCLS = (sql.Function, sql.Case, sql.Identifier, sql.Comparison,
+                sql.IdentifierList, sql.Operation, sql.FunctionParam)
+_LIST_TTYPES = frozenset(T_NUMERICAL + T_STRING + T_NAME
+                         + (T.Keyword, T.Comment, T.Wildcard))
+_LIST_M_ROLE = (T.Keyword, ('null', 'role'))
+_ALIAS_I = (sql.Parenthesis, sql.Function, sql.Case, sql.Identifier,
+            sql.Operation, sql.Comparison)
+
 # These are the set of special keywords which can be used as a function name and as a keyword
 SPECIAL_KEYWORDS = [(T.Keyword, 'CURSOR'), (T.Keyword.DML, 'REPLACE')]
 
+# Values of the Select.M_CLOSE patterns that end a select before UNION
+UNION_MARKERS = frozenset(('UNION', 'UNION ALL'))
+
+# Select.M_CLOSE as (ttype, normalized value) -> value of the pattern, a
+# token closes a select if ``_SELECT_CLOSE.get((ttype, normalized))``.
+_SELECT_CLOSE = dict(
+    ((ttype, value.upper() if ttype in T.Keyword else value), value)
+    for ttype, value in sql.Select.M_CLOSE)
+
+
+def _is_or_as(token):
+    """Checks for the IS or AS keyword starting a function's body.
+
+    Both words always lex as keywords, comparing the normalized value
+    avoids building the upper-cased value of a group.
+    """
+    return token.is_keyword and token.normalized in ('IS', 'AS')
+
+
+# group_for's steps: (in FOR ... IN, token) -> (in FOR ... IN, action).
+# FOR ... IN opens a loop, its LOOP keyword doesn't open another one.
+_FOR_STEPS = {
+    (False, T.ForIn): (True, 'open'),
+    (True, T.ForIn): (True, 'open'),
+    (False, 'LOOP'): (False, 'open'),
+    (True, 'LOOP'): (False, None),
+    (False, 'END LOOP'): (False, 'close'),
+    (True, 'END LOOP'): (True, 'close'),
+}
+
+
+# Grouping passes that only start grouping at certain leaf tokens, with
+# a predicate for those tokens, see grouping._idle_passes()
+_PASS_STARTS = (
+    ('group_comments', imt_predicate(t=T.Comment)),
+    ('align_comments', imt_predicate(t=T.Comment)),
+    ('group_brackets', imt_predicate(m=sql.SquareBrackets.M_OPEN)),
+    ('group_parenthesis', imt_predicate(m=sql.Parenthesis.M_OPEN)),
+    ('group_dml', imt_predicate(m=sql.DML_Operation.M_OPEN)),
+    ('group_case', imt_predicate(m=sql.Case.M_OPEN)),
+    ('group_openlooptag', imt_predicate(m=sql.OpenLoopTag.M_OPEN)),
+    ('group_if', imt_predicate(m=sql.If.M_OPEN)),
+    ('group_begin', imt_predicate(m=sql.Begin.M_OPEN)),
+    ('group_exit', imt_predicate(m=sql.Exit.M_OPEN)),
+    ('group_procedure_heading', imt_predicate(m=sql.ProcedureHeading.M_OPEN)),
+    ('group_function_heading', imt_predicate(m=sql.FunctionHeading.M_OPEN)),
+    ('group_functions', imt_predicate(t=T.Name, m=SPECIAL_KEYWORDS)),
+    ('group_where', imt_predicate(m=sql.Where.M_OPEN)),
+    ('group_union', imt_predicate(m=sql.Union.M_DIVIDER)),
+    ('group_identifier', imt_predicate(t=_IDENT_TTYPES)),
+    ('group_order', imt_predicate(t=T.Keyword.Order)),
+    ('group_package', imt_predicate(m=sql.PackageHeading.M_OPEN)),
+    ('group_cursor_def', imt_predicate(m=sql.CursorDef.M_OPEN)),
+    ('group_exceptions', imt_predicate(m=sql.Exceptions.M_OPEN)),
+    ('group_open', imt_predicate(m=sql.Open.M_OPEN)),
+)
+
+
+# (ttypes, is_open, is_close) per group class, see _matchers()
+_MATCHERS = {}
+
+
+def _matcher(ttype, values):
+    """Returns a function equal to ``token.match(ttype, values)``.
+
+    The values are normalized once instead of on every call.
+    """
+    if values is None:
+        return lambda token: token.ttype is ttype
+    if isinstance(values, string_types):
+        values = (values,)
+    values = frozenset(values)
+    upper = frozenset(v.upper() for v in values)
+
+    def matches(token):
+        if token.ttype is not ttype:
+            return False
+        if token.is_keyword:
+            return token.normalized in upper
+        return token.normalized in values
+    return matches
+
+
+def _matchers(cls):
+    """Returns the token types that can open or close a group of *cls*
+    and the functions matching its M_OPEN and M_CLOSE."""
+    try:
+        return _MATCHERS[cls]
+    except KeyError:
+        matchers = _MATCHERS[cls] = (
+            frozenset((cls.M_OPEN[0], cls.M_CLOSE[0])),
+            _matcher(*cls.M_OPEN), _matcher(*cls.M_CLOSE))
+        return matchers
+
+
+# Group classes removed by grouping.flatter_classes() if they hold a
+# single token
+_FLATTER_CLASSES = (sql.Statement, sql.Identifier)
+
+# Matching Exceptions.M_OPEN and M_CLOSE, for group_exceptions()
+_is_exc_open = _matcher(*sql.Exceptions.M_OPEN)
+_is_exc_close = _matcher(*sql.Exceptions.M_CLOSE)
+
+# Matching PackageHeading.M_OPEN, for group_package()
+_is_package_open = _matcher(*sql.PackageHeading.M_OPEN)
+
+
+def _sublists_first(tlist, cls):
+    """Returns *tlist* and the groups below it that aren't within a group
+    of *cls*, each group after all groups it contains.
+
+    The groups are collected with an explicit stack, not one recursive
+    call per level.
+    """
+    groups = []
+    stack = [tlist]
+    while stack:
+        group = stack.pop()
+        groups.append(group)
+        stack.extend(token for token in group.tokens
+                     if token.is_group and not isinstance(token, cls))
+    groups.reverse()
+    return groups
+
 
 class grouping:
+    # Grouping passes in the order group() runs them
+    _GROUP_PASSES = (
+        'group_comments',
+
+        'group_package',
+
+        'group_brackets',
+        'group_parenthesis',
+        'group_dml',
+        'group_select',
+        'group_case',
+        'group_openlooptag',
+        'group_if',
+        'group_for',
+        'group_begin',
+
+        'group_exit',
+
+        'group_procedure_heading',
+        'group_function_heading',
+
+        'group_function_return_type',
+
+        'group_functions',
+        'group_where',
+
+        'group_union',
+
+        'group_period',
+        'group_arrays',
+        'group_identifier',
+        'group_order',
+        'group_typecasts',
+        'group_operator',
+        'group_notfound',
+        'group_comparison',
+        'group_as',
+        'group_aliased',
+        'group_assignment',
+
+        'align_comments',
+        'group_function_params',
+        'group_identifier_list',
+
+        # flatter_statement_class and flatter_identifier_class
+        'flatter_classes',
+
+        'group_cursor_def',
+
+        # 'group_procedure_heading',
+        'group_procedure_block',
+
+        # 'group_function_heading',
+        'group_function_block',
+
+        'group_declare_section',
+
+        'group_exceptions',
+
+        # 'group_transaction',
+
+        'group_open'
+    )
+
     def __init__(self):
-        pass
+        # bound once, group() runs them for every statement
+        self._passes = tuple(getattr(self, name)
+                             for name in self._GROUP_PASSES)
+        self._pass_starts = tuple((getattr(self, name), starts)
+                                  for name, starts in _PASS_STARTS)
 
     def _group_matching(self, tlist, cls):
         """Groups Tokens that have beginning and end."""
-        opens = []
-        tidx_offset = 0
-        for idx, token in enumerate(list(tlist)):
-            tidx = idx - tidx_offset
-
-            if token.is_whitespace:
-                # ~50% of tokens will be whitespace. Will checking early
-                # for them avoid 3 comparisons, but then add 1 more comparison
-                # for the other ~50% of tokens...
-                continue
+        ttypes, is_open, is_close = _matchers(cls)
+        # groups still to scan, instead of recursing into them
+        stack = [tlist]
+        while stack:
+            tlist = stack.pop()
+            opens = []
+            tidx_offset = 0
+            # no copy of the tokens, tidx_offset maps the position a token
+            # had before grouping to its position in the grouped list
+            tokens = tlist.tokens
+            for idx in range(len(tokens)):
+                tidx = idx - tidx_offset
+                token = tokens[tidx]
+
+                if token.is_group:
+                    if not isinstance(token, cls):
+                        # Check inside previously grouped (ie. parenthesis)
+                        # if group of different type is inside (ie, case)
+                        stack.append(token)
+                    continue
 
-            if token.is_group and not isinstance(token, cls):
-                # Check inside previously grouped (ie. parenthesis) if group
-                # of different type is inside (ie, case). though ideally  should
-                # should check for all open/close tokens at once to avoid recursion
-                # n = grouping()
-                self._group_matching(token, cls)
-                continue
+                if token.ttype not in ttypes:
+                    # most tokens, whitespace included, can't open or close
+                    continue
 
-            if token.match(*cls.M_OPEN):
-                opens.append(tidx)
+                if is_open(token):
+                    opens.append(tidx)
 
-            elif token.match(*cls.M_CLOSE):
-                try:
-                    open_idx = opens.pop()
-                except IndexError:
-                    # this indicates invalid sql and unbalanced tokens.
-                    # instead of break, continue in case other "valid" groups exist
-                    continue
-                close_idx = tidx
-                tlist.group_tokens(cls, open_idx, close_idx)
-                tidx_offset += close_idx - open_idx
+                elif is_close(token):
+                    try:
+                        open_idx = opens.pop()
+                    except IndexError:
+                        # this indicates invalid sql and unbalanced tokens.
+                        # instead of break, continue in case other "valid" groups exist
+                        continue
+                    close_idx = tidx
+                    tlist.group_tokens(cls, open_idx, close_idx)
+                    tidx_offset += close_idx - open_idx
 
     def group_brackets(self, tlist):
         self._group_matching(tlist, sql.SquareBrackets)
@@ -72,98 +297,98 @@ class grouping:
         self._group_matching(tlist, sql.If)
 
     def group_select(self, tlist):
-        opens = []
-        tidx_offset = 0
-        for idx, token in enumerate(list(tlist)):
-            tidx = idx - tidx_offset
-
-            if token.is_whitespace:
-                # ~50% of tokens will be whitespace. Will checking early
-                # for them avoid 3 comparisons, but then add 1 more comparison
-                # for the other ~50% of tokens...
-                continue
+        stack = [tlist]
+        while stack:
+            tlist = stack.pop()
+            opens = []
+            tidx_offset = 0
+            tokens = tlist.tokens
+            for idx in range(len(tokens)):
+                tidx = idx - tidx_offset
+                token = tokens[tidx]
+
+                if token.is_whitespace:
+                    # ~50% of tokens will be whitespace. Will checking early
+                    # for them avoid 3 comparisons, but then add 1 more comparison
+                    # for the other ~50% of tokens...
+                    continue
 
-            if token.is_group and not isinstance(token, sql.Select):
-                # Check inside previously grouped (ie. parenthesis) if group
-                # of different type is inside (ie, case). though ideally  should
-                # should check for all open/close tokens at once to avoid recursion
-                # n = grouping()
-                self.group_select(token)
-                continue
+                if token.is_group and not isinstance(token, sql.Select):
+                    # Check inside previously grouped (ie. parenthesis) if group
+                    # of different type is inside (ie, case). though ideally  should
+                    # should check for all open/close tokens at once to avoid recursion
+                    # n = grouping()
+                    stack.append(token)
+                    continue
 
-            if token.match(*sql.Select.M_OPEN):
-                opens.append(tidx)
+                if token.match(*sql.Select.M_OPEN):
+                    opens.append(tidx)
 
-            else:
-                for matcher in sql.Select.M_CLOSE:
-                    if token.match(*matcher):
-                        try:
-                            open_idx = opens.pop()
-                        except IndexError:
-                            # this indicates invalid sql and unbalanced tokens.
-                            # instead of break, continue in case other "valid" groups exist
-                            break
-                        close_idx = tidx
-                        if matcher[1].upper() == "UNION" or matcher[1].upper() == "UNION ALL":
-                            close_idx = tlist.token_prev(idx=tidx, skip_cm=True)[0]
-                        tlist.group_tokens(sql.Select, open_idx, close_idx)
-                        tidx_offset += close_idx - open_idx
-                        break
-                continue
-        if len(opens) == 1 and isinstance(tlist, sql.Parenthesis):
-            tlist.group_tokens(sql.Select, opens.pop(), len(tlist.tokens) - 2)
+                else:
+                    close = _SELECT_CLOSE.get((token.ttype, token.normalized))
+                    if close is None:
+                        continue
+                    if not opens:
+                        # this indicates invalid sql and unbalanced tokens.
+                        # instead of break, continue in case other "valid" groups exist
+                        continue
+                    open_idx = opens.pop()
+                    close_idx = tidx
+                    if close in UNION_MARKERS:
+                        close_idx = tlist.token_prev(idx=tidx, skip_cm=True)[0]
+                    tlist.group_tokens(sql.Select, open_idx, close_idx)
+                    tidx_offset += close_idx - open_idx
+            if len(opens) == 1 and isinstance(tlist, sql.Parenthesis):
+                tlist.group_tokens(sql.Select, opens.pop(), len(tlist.tokens) - 2)
 
     def group_dml(self, tlist):
         self._group_matching(tlist, sql.DML_Operation)
 
     def group_for(self, tlist):
-        opens = []
-        tidx_offset = 0
         cls = sql.For
-        in_for = False
-        for idx, token in enumerate(list(tlist)):
-            tidx = idx - tidx_offset
-
-            if token.is_whitespace:
-                # ~50% of tokens will be whitespace. Will checking early
-                # for them avoid 3 comparisons, but then add 1 more comparison
-                # for the other ~50% of tokens...
-                continue
-
-            if token.is_group and not isinstance(token, cls):
-                # Check inside previously grouped (ie. parenthesis) if group
-                # of different type is inside (ie, case). though ideally  should
-                # should check for all open/close tokens at once to avoid recursion
-                # n = grouping()
-                self.group_for(token)
-                continue
-
-            matched = False
-            for matcher in cls.M_OPEN:
-                if token.match(*matcher):
-                    if token.ttype == T.ForIn:
-                        matched = True
-                        in_for = True
-                        opens.append(tidx)
-                    else:
-                        if not in_for:
-                            matched = True
-                            opens.append(tidx)
-                        else:
-                            matched = True
-                            in_for = False
-                    break
+        stack = [tlist]
+        while stack:
+            tlist = stack.pop()
+            opens = []
+            tidx_offset = 0
+            in_for = False
+            tokens = tlist.tokens
+            for idx in range(len(tokens)):
+                tidx = idx - tidx_offset
+                token = tokens[tidx]
+
+                if token.is_group:
+                    if not isinstance(token, cls):
+                        # Check inside previously grouped (ie. parenthesis)
+                        # if group of different type is inside (ie, case)
+                        stack.append(token)
+                    continue
 
-            if not matched and token.match(*cls.M_CLOSE):
+                ttype = token.ttype
+                if ttype is T.ForIn:
+                    key = in_for, ttype
+                elif ttype is T.Keyword:
+                    key = in_for, token.normalized
+                else:
+                    continue
                 try:
-                    open_idx = opens.pop()
-                except IndexError:
-                    # this indicates invalid sql and unbalanced tokens.
-                    # instead of break, continue in case other "valid" groups exist
+                    in_for, action = _FOR_STEPS[key]
+                except KeyError:
                     continue
-                close_idx = tidx
-                tlist.group_tokens(cls, open_idx, close_idx)
-                tidx_offset += close_idx - open_idx
+
+                if action == 'open':
+                    opens.append(tidx)
+
+                elif action == 'close':
+                    try:
+                        open_idx = opens.pop()
+                    except IndexError:
+                        # this indicates invalid sql and unbalanced tokens.
+                        # instead of break, continue in case other "valid" groups exist
+                        continue
+                    close_idx = tidx
+                    tlist.group_tokens(cls, open_idx, close_idx)
+                    tidx_offset += close_idx - open_idx
 
     def group_begin(self, tlist):
         self._group_matching(tlist, sql.Begin)
@@ -192,9 +417,8 @@ class grouping:
             return token.match(T.Punctuation, '.')
 
         def valid_prev(token):
-            sqlcls = sql.SquareBrackets, sql.Identifier, sql.Function
-            ttypes = T.Name, T.String.Symbol
-            return imt(token, i=sqlcls, t=ttypes)
+            return token is not None and (isinstance(token, _PERIOD_PREV_SQLCLS)
+                                          or token.ttype in _PERIOD_PREV_TTYPES)
 
         def valid_next(token):
             # issue261, allow invalid next token
@@ -202,10 +426,9 @@ class grouping:
 
         def post(tlist, pidx, tidx, nidx):
             # next_ validation is being performed here. issue261
-            sqlcls = sql.SquareBrackets, sql.Function
-            ttypes = T.Name, T.String.Symbol, T.Wildcard
             next_ = tlist[nidx] if nidx is not None else None
-            valid_next = imt(next_, i=sqlcls, t=ttypes)
+            valid_next = next_ is not None and (isinstance(next_, _PERIOD_NEXT_SQLCLS)
+                                                or next_.ttype in _PERIOD_NEXT_TTYPES)
 
             return (pidx, nidx) if valid_next else (pidx, tidx)
 
@@ -221,8 +444,7 @@ class grouping:
                    and not isinstance(token, sql.Comment)
 
         def valid_next(token):
-            ttypes = T.DML, T.DDL
-            return not imt(token, t=ttypes) and token is not None
+            return not imt(token, t=_AS_NEXT_TTYPES) and token is not None
 
         def post(tlist, pidx, tidx, nidx):
             return pidx, nidx
@@ -247,10 +469,17 @@ class grouping:
         self._group(tlist, sql.Assignment, match, valid_prev, valid_next, post)
 
     def group_notfound(self, tlist, cls=sql.NotFound):
+        # sublists first, see _group()
+        for group in _sublists_first(tlist, cls):
+            self._group_notfound(group, cls)
+
+    def _group_notfound(self, tlist, cls):
         opens = []
         tidx_offset = 0
-        for idx, token in enumerate(list(tlist)):
+        tokens = tlist.tokens
+        for idx in range(len(tokens)):
             tidx = idx - tidx_offset
+            token = tokens[tidx]
 
             if token.is_whitespace:
                 # ~50% of tokens will be whitespace. Will checking early
@@ -259,11 +488,8 @@ class grouping:
                 continue
 
             if token.is_group and not isinstance(token, cls):
-                # Check inside previously grouped (ie. parenthesis) if group
-                # of different type is inside (ie, case). though ideally  should
-                # should check for all open/close tokens at once to avoid recursion
-                # n = grouping()
-                self.group_notfound(token, cls)
+                # previously grouped (ie. parenthesis), its tokens were
+                # already checked by group_notfound()
                 opens = None
                 continue
 
@@ -281,19 +507,13 @@ class grouping:
                 opens = None
 
     def group_comparison(self, tlist):
-        sqlcls = (sql.Parenthesis, sql.Function, sql.Identifier, sql.Operation, sql.NotFound)
-        ttypes = T_NUMERICAL + T_STRING + T_NAME + (T.Keyword, T.Name.Builtin) + (T.Name.Negative,)
-
         def match(token):
             return token.ttype == T.Operator.Comparison
 
         def valid(token):
-            if imt(token, t=ttypes, i=sqlcls):
-                return True
-            elif token and token.is_keyword:
-                return True
-            else:
-                return False
+            return token is not None and (isinstance(token, _CMP_SQLCLS)
+                                          or token.ttype in _CMP_TTYPES
+                                          or token.is_keyword)
 
         def post(tlist, pidx, tidx, nidx):
             return pidx, nidx
@@ -304,22 +524,18 @@ class grouping:
 
     @recurse(sql.Identifier)
     def group_identifier(self, tlist):
-        ttypes = (T.String.Symbol, T.Name)
-
-        tidx, token = tlist.token_next_by(t=ttypes)
+        tidx, token = tlist.token_next_by(t=_IDENT_TTYPES)
         while token:
             tlist.group_tokens(sql.Identifier, tidx, tidx)
-            tidx, token = tlist.token_next_by(t=ttypes, idx=tidx)
+            tidx, token = tlist.token_next_by(t=_IDENT_TTYPES, idx=tidx)
 
     def group_arrays(self, tlist):
-        sqlcls = sql.SquareBrackets, sql.Identifier, sql.Function
-        ttypes = T.Name, T.String.Symbol
-
         def match(token):
             return isinstance(token, sql.SquareBrackets)
 
         def valid_prev(token):
-            return imt(token, i=sqlcls, t=ttypes)
+            return token is not None and (isinstance(token, _ARRAY_SQLCLS)
+                                          or token.ttype in _ARRAY_TTYPES)
 
         def valid_next(token):
             return True
@@ -331,15 +547,12 @@ class grouping:
                     valid_prev, valid_next, post, extend=True, recurse=False)
 
     def group_operator(self, tlist):
-        ttypes = T_NUMERICAL + T_STRING + T_NAME
-        sqlcls = (sql.SquareBrackets, sql.Parenthesis, sql.Function,
-                  sql.Identifier, sql.Operation)
-
         def match(token):
-            return imt(token, t=(T.Operator, T.Wildcard))
+            return token.ttype in _OP_MATCH_TTYPES
 
         def valid(token):
-            return imt(token, i=sqlcls, t=ttypes)
+            return token is not None and (isinstance(token, _OP_SQLCLS)
+                                          or token.ttype in _OP_TTYPES)
 
         def post(tlist, pidx, tidx, nidx):
             tlist[tidx].ttype = T.Operator
@@ -350,16 +563,13 @@ class grouping:
                     valid_prev, valid_next, post, extend=False)
 
     def group_identifier_list(self, tlist):
-        m_role = T.Keyword, ('null', 'role')
-        sqlcls = (sql.Function, sql.Case, sql.Identifier, sql.Comparison,
-                  sql.IdentifierList, sql.Operation, sql.FunctionParam)
-        ttypes = (T_NUMERICAL + T_STRING + T_NAME + (T.Keyword, T.Comment, T.Wildcard))
-
         def match(token):
             return token.match(T.Punctuation, ',')
 
         def valid(token):
-            return imt(token, i=sqlcls, m=m_role, t=ttypes)
+            return token is not None and (isinstance(token, _LIST_SQLCLS)
+                                          or token.ttype in _LIST_TTYPES
+                                          or token.match(*_LIST_M_ROLE))
 
         def post(tlist, pidx, tidx, nidx):
             return pidx, nidx
@@ -370,13 +580,16 @@ class grouping:
 
     @recurse(sql.Comment)
     def group_comments(self, tlist):
+        tokens = tlist.tokens
         tidx, token = tlist.token_next_by(t=T.Comment)
         while token:
-            eidx, end = tlist.token_not_matching(
-                lambda tk: imt(tk, t=T.Comment) or tk.is_whitespace, idx=tidx)
-            if end is not None:
-                eidx, end = tlist.token_prev(eidx, skip_ws=False)
-                tlist.group_tokens(sql.Comment, tidx, eidx)
+            # end of the run of comments and whitespace
+            eidx = tidx + 1
+            while eidx < len(tokens) and (tokens[eidx].ttype in T.Comment
+                                          or tokens[eidx].is_whitespace):
+                eidx += 1
+            if eidx < len(tokens):
+                tlist.group_tokens(sql.Comment, tidx, eidx - 1)
 
             tidx, token = tlist.token_next_by(t=T.Comment, idx=tidx)
 
@@ -389,7 +602,7 @@ class grouping:
             # if _next.value.upper() == 'RETURN':
             #     _rtypeidx, _rtype = tlist.token_next(idx=_nidx, skip_cm=True, skip_ws=True)
             #     _nid, _ntk = tlist.token_next(idx=_rtypeidx, skip_cm=True, skip_ws=True)
-            if _next and (_next.value.upper() == 'IS' or _next.value.upper() == 'AS'):
+            if _next and _is_or_as(_next):
                 while self._internal_fun_proc_grouping(tlist, _nidx):
                     continue
                 bid, btoken = tlist.token_next_by(i=sql.Begin, idx=_nidx)
@@ -413,49 +626,21 @@ class grouping:
     def _internal_fun_proc_grouping(self, tlist, _nidx):
         bid, btoken = tlist.token_next_by(i=sql.Begin, idx=_nidx)
         if btoken:
-            ph_temp_id, ph_temp_tk = tlist.token_next_by(i=sql.ProcedureHeading, idx=_nidx)
-            fh_temp_id, fh_temp_tk = tlist.token_next_by(i=sql.FunctionHeading, idx=_nidx)
-            if ph_temp_tk and fh_temp_tk and ph_temp_id < bid and fh_temp_id < bid:
-                diff_ph = ph_temp_id - _nidx
-                diff_fh = fh_temp_id - _nidx
-
-                if diff_ph < diff_fh:
-                    _nidx, _next = tlist.token_next(idx=ph_temp_id, skip_cm=True, skip_ws=True)
-                    if _next.value.upper() == 'IS' or _next.value.upper() == 'AS':
-                        self._internal_fun_proc_grouping(tlist, _nidx)
-                        bid, token = tlist.token_next_by(i=sql.Begin, idx=_nidx)
-                        if token:
-                            end, token = tlist.token_next(idx=bid, skip_cm=True, skip_ws=True)
-                            tlist.group_tokens(sql.ProcedureBlock, ph_temp_id, end)
-                            return True
-                elif diff_ph > diff_fh:
-                    _nidx, _next = tlist.token_next(idx=fh_temp_id, skip_cm=True, skip_ws=True)
-                    if _next.value.upper() == 'IS' or _next.value.upper() == 'AS':
-                        self._internal_fun_proc_grouping(tlist, _nidx)
-                        bid, token = tlist.token_next_by(i=sql.Begin, idx=_nidx)
-                        if token:
-                            end, token = tlist.token_next(idx=bid, skip_cm=True, skip_ws=True)
-                            tlist.group_tokens(sql.FunctionBlock, fh_temp_id, end)
-                            return True
-
-            elif ph_temp_tk and ph_temp_id < bid:
-                _nidx, _next = tlist.token_next(idx=ph_temp_id, skip_cm=True, skip_ws=True)
-                if _next.value.upper() == 'IS' or _next.value.upper() == 'AS':
+            # the first heading before BEGIN starts a nested block
+            hidx, heading = tlist.token_next_by(
+                i=(sql.ProcedureHeading, sql.FunctionHeading),
+                idx=_nidx, end=bid)
+            if heading:
+                _nidx, _next = tlist.token_next(idx=hidx, skip_cm=True, skip_ws=True)
+                if _is_or_as(_next):
                     self._internal_fun_proc_grouping(tlist, _nidx)
                     bid, token = tlist.token_next_by(i=sql.Begin, idx=_nidx)
                     if token:
                         end, token = tlist.token_next(idx=bid, skip_cm=True, skip_ws=True)
-                        tlist.group_tokens(sql.ProcedureBlock, ph_temp_id, end)
-                        return True
-
-            elif fh_temp_tk and fh_temp_id < bid:
-                _nidx, _next = tlist.token_next(idx=fh_temp_id, skip_cm=True, skip_ws=True)
-                if _next.value.upper() == 'IS' or _next.value.upper() == 'AS':
-                    self._internal_fun_proc_grouping(tlist, _nidx)
-                    bid, token = tlist.token_next_by(i=sql.Begin, idx=_nidx)
-                    if token:
-                        end, token = tlist.token_next(idx=bid, skip_cm=True, skip_ws=True)
-                        tlist.group_tokens(sql.FunctionBlock, fh_temp_id, end)
+                        if isinstance(heading, sql.ProcedureHeading):
+                            tlist.group_tokens(sql.ProcedureBlock, hidx, end)
+                        else:
+                            tlist.group_tokens(sql.FunctionBlock, hidx, end)
                         return True
         return False
 
@@ -465,7 +650,7 @@ class grouping:
 
         while token:
             _nidx, _next = tlist.token_next(idx=start, skip_cm=True, skip_ws=True)
-            if _next and (_next.value.upper() == 'IS' or _next.value.upper() == 'AS'):
+            if _next and _is_or_as(_next):
                 while self._internal_fun_proc_grouping(tlist, _nidx):
                     continue
                 bid, btoken = tlist.token_next_by(i=sql.Begin, idx=_nidx)
@@ -496,8 +681,10 @@ class grouping:
                 end, param = prntkn.token_next_by(m=sql.FunctionParam.SEPARATOR)
                 if param:
                     while param:
-                        prntkn.group_tokens(sql.FunctionParam, start, prntkn.token_prev(end, skip_cm=True)[0])
-                        start = prntkn.token_next(prntkn.token_index(param), skip_cm=True)[0]
+                        pend = prntkn.token_prev(end, skip_cm=True)[0]
+                        prntkn.group_tokens(sql.FunctionParam, start, pend)
+                        # the separator moved back by the grouped tokens
+                        start = prntkn.token_next(end - (pend - start), skip_cm=True)[0]
                         end, param = prntkn.token_next_by(m=sql.FunctionParam.SEPARATOR, idx=start)
                     cidx, ctkn = prntkn.token_next_by(m=sql.Parenthesis.M_CLOSE)
                     end, etkn = prntkn.token_prev(cidx, skip_cm=True)
@@ -548,11 +735,9 @@ class grouping:
 
             if end is None:
                 end = tlist._groupable_tokens[-1]
+                eidx = tlist.token_index(end)
             else:
-                end = tlist.tokens[eidx - 1]
-            # TODO: convert this to eidx instead of end token.
-            # i think above values are len(tlist) and eidx-1
-            eidx = tlist.token_index(end)
+                eidx -= 1
             tlist.group_tokens(sql.Where, tidx, eidx)
             tidx, token = tlist.token_next_by(m=sql.Where.M_OPEN, idx=tidx)
 
@@ -565,20 +750,18 @@ class grouping:
             extend = False
             if isinstance(ptk, sql.Union):
                 extend = True
-            tidx, token = tlist.token_next_by(m=sql.Union.M_DIVIDER, idx=tlist.token_index(
-                tlist.group_tokens(sql.Union, pid, nid, extend=extend)))
+            tlist.group_tokens(sql.Union, pid, nid, extend=extend)
+            # the group takes the place of its first token
+            tidx, token = tlist.token_next_by(m=sql.Union.M_DIVIDER, idx=pid)
 
     @recurse()
     def group_aliased(self, tlist):
-        I_ALIAS = (sql.Parenthesis, sql.Function, sql.Case, sql.Identifier,
-                   sql.Operation, sql.Comparison)
-
-        tidx, token = tlist.token_next_by(i=I_ALIAS, t=T.Number)
+        tidx, token = tlist.token_next_by(i=_ALIAS_I, t=T.Number)
         while token:
             nidx, next_ = tlist.token_next(tidx)
             if isinstance(next_, sql.Identifier):
                 tlist.group_tokens(sql.Identifier, tidx, nidx, extend=True)
-            tidx, token = tlist.token_next_by(i=I_ALIAS, t=T.Number, idx=tidx)
+            tidx, token = tlist.token_next_by(i=_ALIAS_I, t=T.Number, idx=tidx)
 
     @recurse(sql.Function)
     def group_functions(self, tlist):
@@ -608,7 +791,7 @@ class grouping:
                 nidx, next_ = tlist.token_next(tidx)
                 if isinstance(next_, sql.Parenthesis):
                     tlist.group_tokens(sql.ProcedureHeading, proid, nidx)
-                elif next_.value.upper() == "IS" or next_.value.upper() == "AS":
+                elif _is_or_as(next_):
                     tlist.group_tokens(sql.ProcedureHeading, proid, tidx)
             proid, token = tlist.token_next_by(m=sql.ProcedureHeading.M_OPEN, idx=proid)
 
@@ -649,16 +832,7 @@ class grouping:
             stmid, stmt = tlist.token_next_by(i=sql.Statement, idx=stmid)
 
     def _flatter_statement_class(self, stmt, stmid):
-        if isinstance(stmt, sql.Statement) and len(stmt.tokens) == 1:
-            stmt.parent.pop(stmid)
-            stmt.parent.insert_before(stmid, stmt.tokens[0])
-            self._flatter_statement_class(stmt.tokens[0], stmid)
-        elif stmt.is_group:
-            for sid, stkn in enumerate(stmt.tokens):
-                if isinstance(stkn, sql.Statement):
-                    self._flatter_statement_class(stkn, sid)
-                elif stkn.is_group:
-                    self._flatter_statement_class(stkn, sid)
+        self._flatter_class(stmt, stmid, sql.Statement)
 
     @recurse(sql.Identifier)
     def flatter_identifier_class(self, tlist):
@@ -669,16 +843,40 @@ class grouping:
             stmid, stmt = tlist.token_next_by(i=sql.Identifier, idx=stmid)
 
     def _flatter_identifier_class(self, stmt, stmid):
-        if isinstance(stmt, sql.Identifier) and len(stmt.tokens) == 1:
-            stmt.parent.pop(stmid)
-            stmt.parent.insert_before(stmid, stmt.tokens[0])
-            self._flatter_identifier_class(stmt.tokens[0], stmid)
-        elif stmt.is_group:
-            for sid, stkn in enumerate(stmt.tokens):
-                if isinstance(stkn, sql.Identifier):
-                    self._flatter_identifier_class(stkn, sid)
-                elif stkn.is_group:
-                    self._flatter_identifier_class(stkn, sid)
+        self._flatter_class(stmt, stmid, sql.Identifier)
+
+    @recurse(*_FLATTER_CLASSES)
+    def flatter_classes(self, tlist):
+        """flatter_statement_class and flatter_identifier_class in a
+        single walk.
+
+        Flattening keeps the length of every parent, so the groups
+        holding a single token are the same whichever class is flattened
+        first.
+        """
+        stmid, stmt = tlist.token_next_by(i=_FLATTER_CLASSES)
+
+        while stmt:
+            self._flatter_class(stmt, stmid, _FLATTER_CLASSES)
+            stmid, stmt = tlist.token_next_by(i=_FLATTER_CLASSES, idx=stmid)
+
+    @staticmethod
+    def _flatter_class(stmt, stmid, cls):
+        """Replaces each group of *cls* holding a single token, at *stmid*
+        within its parent and below, by that token."""
+        # (token, index within its parent) still to flatten
+        stack = [(stmt, stmid)]
+        while stack:
+            stmt, stmid = stack.pop()
+            while isinstance(stmt, cls) and len(stmt.tokens) == 1:
+                stmt.parent.pop(stmid)
+                stmt.parent.insert_before(stmid, stmt.tokens[0])
+                stmt = stmt.tokens[0]
+            if stmt.is_group:
+                children = [(token, idx)
+                            for idx, token in enumerate(stmt.tokens)]
+                children.reverse()
+                stack.extend(children)
 
     @recurse(sql.Transaction)
     def group_transaction(self, tlist):
@@ -688,33 +886,29 @@ class grouping:
             bindx, token = tlist.token_next_by(i=sql.Begin, idx=bindx)
 
     def _group_transaction(self, btkn):
-        tidx_offset = 0
-        pidx, prev_, is_commit = None, None, False
+        is_commit = False
         start_idx = 0
         if isinstance(btkn, sql.Begin):
             start_idx = 1
         elif isinstance(btkn, sql.For):
             start_idx = btkn.loop_idx + 1
 
-        for idx, token in enumerate(list(btkn)):
-            tidx = idx - tidx_offset
-
-            if token.is_whitespace:
+        # (start, end) of each transaction, grouped from right to left
+        # after the scan so that the indices of the others stay valid
+        found = []
+        skip_idx = None
+        for tidx, token in enumerate(btkn.tokens):
+            if token.is_whitespace or tidx == skip_idx:
                 continue
 
             if token.is_group and not isinstance(token, sql.Transaction):
                 if self._group_transaction(token):
-                    if isinstance(token, sql.If):
-                        grp = btkn.group_tokens(sql.Transaction, tidx, tidx + 1)
                     if not isinstance(btkn, sql.If):
-                        grp = btkn.group_tokens(sql.Transaction, start_idx, tidx - 1)
-                        start_idx = btkn.token_index(grp)
-                        start_idx += 3
-                        tidx_offset += tidx - start_idx
-                        tidx_offset += 2
-                        if isinstance(token, sql.If):
-                            start_idx = start_idx - 1
-                            tidx_offset = tidx_offset + 1
+                        found.append((start_idx, tidx - 1))
+                        start_idx = tidx + 2
+                    if isinstance(token, sql.If):
+                        found.append((tidx, tidx + 1))
+                        skip_idx = tidx + 1
                     is_commit = True
                 continue
 
@@ -722,14 +916,13 @@ class grouping:
                 to_idx, next_ = btkn.token_next(tidx)
                 if next_.value == ';':
                     if not isinstance(btkn, sql.If):
-                        grp = btkn.group_tokens(sql.Transaction, start_idx, to_idx)
-                        start_idx = btkn.token_index(grp)
-                        start_idx += 1
-                        tidx_offset += to_idx - start_idx
-                        tidx_offset += 1
+                        found.append((start_idx, to_idx))
+                        start_idx = to_idx + 1
                     is_commit = True
                 continue
 
+        for start, end in reversed(found):
+            btkn.group_tokens(sql.Transaction, start, end)
         return is_commit
 
     def group_order(self, tlist):
@@ -747,8 +940,14 @@ class grouping:
         tidx, token = tlist.token_next_by(i=sql.Comment)
         while token:
             pidx, prev_ = tlist.token_prev(tidx)
-            if isinstance(prev_, sql.TokenList):
-                tlist.group_tokens(sql.TokenList, pidx, tidx, extend=True)
+            if prev_ is not None and prev_.is_group:
+                # attach the whole run of comments in one call
+                eidx = tidx
+                nidx, next_ = tlist.token_next(eidx)
+                while isinstance(next_, sql.Comment):
+                    eidx = nidx
+                    nidx, next_ = tlist.token_next(eidx)
+                tlist.group_tokens(sql.TokenList, pidx, eidx, extend=True)
                 tidx = pidx
             tidx, token = tlist.token_next_by(i=sql.Comment, idx=tidx)
 
@@ -776,11 +975,14 @@ class grouping:
             if token.is_group and not isinstance(token, sql.Package):
                 self.group_package(token)
 
-            if not isinstance(token, sql.Package) and imt(token, m=sql.PackageHeading.M_OPEN):
+            # a Package (or any group) has no ttype and never matches
+            if _is_package_open(token):
                 iidx, itoken = tlist.token_next_by(m=sql.PackageHeading.M_NEXT, idx=tidx)
                 if itoken:
-                    last = tlist.parent.token_last(skip_cm=True)
-                    tlist.parent.group_tokens(sql.Statement, 0, tlist.parent.token_index(last), extend=True)
+                    parent = tlist.parent
+                    # position of parent.token_last(skip_cm=True)
+                    lidx, _ = parent.token_prev(len(parent.tokens), skip_cm=True)
+                    parent.group_tokens(sql.Statement, 0, lidx, extend=True)
                     aidx, token = tlist.token_next_by(m=sql.PackageHeading.M_CLOSE)
                     tlist.group_tokens(sql.PackageHeading, iidx, aidx)
                     tlist.group_tokens(sql.Package, tidx, len(tlist.tokens))  # .get_fp()
@@ -799,32 +1001,31 @@ class grouping:
             tidx, token = tlist.token_next_by(m=sql.CursorDef.M_OPEN, idx=tidx)
 
     def group_exceptions(self, tlist):
-        def match(token):
-            return token.is_keyword and (token.match(*sql.Exceptions.M_OPEN) or token.match(*sql.Exceptions.M_CLOSE))
-
-        def valid_prev(token):
-            return token.is_keyword and token.match(*sql.Exceptions.M_OPEN)
-
-        def valid_next(token):
-            return token is not None and token.is_keyword and token.match(*sql.Exceptions.M_CLOSE)
-
-        def post(tlist, pidx, tidx):
-            return pidx, tlist.token_prev(tidx, skip_cm=True)[0]
+        # sublists first, see _group()
+        for group in _sublists_first(tlist, sql.Exceptions):
+            self._group_exceptions(group)
 
+    def _group_exceptions(self, tlist):
         tidx_offset = 0
         pidx, prev_ = None, None
-        for idx, token in enumerate(list(tlist)):
+        # walked in place until the first group, see _group_list()
+        tokens = tlist.tokens
+        idx = -1
+        while idx + 1 < len(tokens):
+            idx += 1
+            token = tokens[idx]
             tidx = idx - tidx_offset
 
             if token.is_whitespace:
                 continue
 
-            if token.is_group and not isinstance(token, sql.Exceptions):
-                self.group_exceptions(token)
-
-            if match(token):
-                if prev_ and valid_prev(prev_) and valid_next(token):
-                    from_idx, to_idx = post(tlist, pidx, tidx)
+            is_close = _is_exc_close(token)
+            if is_close or _is_exc_open(token):
+                if is_close and prev_ and _is_exc_open(prev_):
+                    from_idx = pidx
+                    to_idx = tlist.token_prev(tidx, skip_cm=True)[0]
+                    if tokens is tlist.tokens:
+                        tokens = list(tokens)
                     grp = tlist.group_tokens(sql.Exceptions, from_idx, to_idx)
 
                     tidx_offset += to_idx - from_idx
@@ -833,70 +1034,31 @@ class grouping:
 
                 pidx, prev_ = tidx, token
 
-    def group(self, stmt):
-        for func in [
-            self.group_comments,
-
-            self.group_package,
-
-            self.group_brackets,
-            self.group_parenthesis,
-            self.group_dml,
-            self.group_select,
-            self.group_case,
-            self.group_openlooptag,
-            self.group_if,
-            self.group_for,
-            self.group_begin,
-
-            self.group_exit,
-
-            self.group_procedure_heading,
-            self.group_function_heading,
+    def _idle_passes(self, stmt):
+        """Returns the grouping passes that can't group anything in *stmt*.
+
+        Grouping never changes the leaf tokens. A pass that only starts
+        grouping at certain leaf tokens has nothing to do if none of them
+        occurs in *stmt*.
+        """
+        # one token per distinct (ttype, normalized), all others match
+        # or don't match the same way
+        leaves = {}
+        for token in stmt.flatten():
+            leaves.setdefault((token.ttype, token.normalized), token)
+        leaves = list(leaves.values())
+
+        idle = set()
+        for func, starts in self._pass_starts:
+            if not any(starts(token) for token in leaves):
+                idle.add(func)
+        return idle
 
-            self.group_function_return_type,
-
-            self.group_functions,
-            self.group_where,
-
-            self.group_union,
-
-            self.group_period,
-            self.group_arrays,
-            self.group_identifier,
-            self.group_order,
-            self.group_typecasts,
-            self.group_operator,
-            self.group_notfound,
-            self.group_comparison,
-            self.group_as,
-            self.group_aliased,
-            self.group_assignment,
-
-            self.align_comments,
-            self.group_function_params,
-            self.group_identifier_list,
-
-            self.flatter_statement_class,
-            self.flatter_identifier_class,
-
-            self.group_cursor_def,
-
-            # self.group_procedure_heading,
-            self.group_procedure_block,
-
-            # self.group_function_heading,
-            self.group_function_block,
-
-            self.group_declare_section,
-
-            self.group_exceptions,
-
-            # self.group_transaction,
-
-            self.group_open
-        ]:
-            func(stmt)
+    def group(self, stmt):
+        idle = self._idle_passes(stmt)
+        for func in self._passes:
+            if func not in idle:
+                func(stmt)
         return stmt
 
     def _group(self, tlist, cls, match,
@@ -908,22 +1070,43 @@ class grouping:
                skip_cm=False
                ):
         """Groups together tokens that are joined by a middle token. ie. x < y"""
-
+        if not recurse:
+            self._group_list(tlist, cls, match, valid_prev, valid_next, post,
+                             extend, skip_cm)
+            return
+
+        # Grouping a list only looks at the classes of its sublists, so
+        # they can be grouped first
+        for group in _sublists_first(tlist, cls):
+            self._group_list(group, cls, match, valid_prev, valid_next, post,
+                             extend, skip_cm)
+
+    @staticmethod
+    def _group_list(tlist, cls, match, valid_prev, valid_next, post, extend,
+                    skip_cm):
+        """Groups the tokens of *tlist* for _group(), not its sublists."""
         tidx_offset = 0
         pidx, prev_ = None, None
-        for idx, token in enumerate(list(tlist)):
+        # Most passes group nothing in most lists, so the tokens are
+        # walked in place and only copied before the first group. The
+        # loop then goes on over the tokens as they were, including the
+        # ones moved into a group.
+        tokens = tlist.tokens
+        idx = -1
+        while idx + 1 < len(tokens):
+            idx += 1
+            token = tokens[idx]
             tidx = idx - tidx_offset
 
             if token.is_whitespace:
                 continue
 
-            if recurse and token.is_group and not isinstance(token, cls):
-                self._group(token, cls, match, valid_prev, valid_next, post, extend, skip_cm=skip_cm)
-
             if match(token):
                 nidx, next_ = tlist.token_next(tidx, skip_cm=skip_cm)
                 if prev_ and valid_prev(prev_) and valid_next(next_):
                     from_idx, to_idx = post(tlist, pidx, tidx, nidx)
+                    if tokens is tlist.tokens:
+                        tokens = list(tokens)
                     grp = tlist.group_tokens(cls, from_idx, to_idx, extend=extend)
 
                     tidx_offset += to_idx - from_idx
@@ -7,6 +7,23 @@
 
 from bsqlparse import sql, tokens as T
 
+# Keywords that can change the split level, besides FOR ... IN, and
+# their kind as tested in StatementSplitter._change_splitlevel()
+_SPLITLEVEL_KINDS = {
+    'CREATE OR REPLACE': 'CREATE_OR_REPLACE',
+    'DECLARE': 'DECLARE',
+    'BEGIN': 'BEGIN',
+    'END': 'END',
+    'LOOP': 'LOOP',
+    'CASE': 'CASE',
+    'IF': 'IF',
+    'WHILE': 'WHILE',
+    'END CASE': 'END_CASE',
+    'END IF': 'END_BLOCK',
+    'END WHILE': 'END_BLOCK',
+    'END LOOP': 'END_BLOCK',
+}
+
 
 class StatementSplitter(object):
     """Filter that split stream at individual statements"""
@@ -26,9 +43,15 @@ class StatementSplitter(object):
         self.consume_ws = False
         self.tokens = []
         self.level = 0
+        # the open token list at each depth, self.tokens at depth 0
+        self._stack = [self.tokens]
+
+    def _change_splitlevel(self, ttype, unified):
+        """Get the new split level (increase, decrease or remain equal)
 
-    def _change_splitlevel(self, ttype, value):
-        """Get the new split level (increase, decrease or remain equal)"""
+        *unified* is the token's normalized value, keywords are already
+        upper-cased.
+        """
         # ANSI
         # if normal token return
         # wouldn't parenthesis increase/decrease a level?
@@ -39,20 +62,25 @@ class StatementSplitter(object):
         # Everything after here is ttype = T.Keyword
         # Also to note, once entered an If statement you are done and basically
         # returning
-        unified = value.upper()
+        if ttype is T.ForIn:
+            kind = 'FOR'
+        else:
+            kind = _SPLITLEVEL_KINDS.get(unified)
+            if kind is None:
+                return 0
 
         # three keywords begin with CREATE, but only one of them is DDL
         # DDL Create though can contain more words such as "or replace"
-        if ttype is T.Keyword.DDL and unified == "CREATE OR REPLACE":
+        if ttype is T.Keyword.DDL and kind == 'CREATE_OR_REPLACE':
             self._is_create = True
             return 1
 
         # can have nested declare inside of being...
-        if unified == 'DECLARE' and self._is_create and self._begin_depth == 0:
+        if kind == 'DECLARE' and self._is_create and self._begin_depth == 0:
             self._in_declare = True
             return 1
 
-        if unified == 'BEGIN':
+        if kind == 'BEGIN':
             self._begin_depth += 1
             if self._is_create:
                 # FIXME(andi): This makes no sense.
@@ -63,16 +91,15 @@ class StatementSplitter(object):
         # In CASE ... WHEN ... END this results in a split level -1.
         # Would having multiple CASE WHEN END and a Assignment Operator
         # cause the statement to cut off prematurely?
-        if unified == 'END':
+        if kind == 'END':
             if self._in_case > 0:
                 self._in_case = self._in_case - 1
                 return -1
             self._begin_depth = max(0, self._begin_depth - 1)
             return -1
 
-        if ((unified.startswith('FOR')
-             and ttype == T.ForIn) or unified == 'LOOP') and self._is_create and self._begin_depth > 0:
-            if unified.startswith('FOR'):
+        if kind in ('FOR', 'LOOP') and self._is_create and self._begin_depth > 0:
+            if kind == 'FOR':
                 self._infor = True
                 return 1
             if self._infor:
@@ -85,24 +112,24 @@ class StatementSplitter(object):
                 return 1
 
         # Case can be outside the begin as well
-        if unified == 'CASE':
+        if kind == 'CASE':
             self._in_case = self._in_case + 1
             return 1
 
         # if (unified in ('IF', 'FOR', 'WHILE', 'LOOP') and
         # if unified in ('IF', 'WHILE', 'CASE') and self._is_create and self._begin_depth > 0:
-        if unified in ('IF', 'WHILE') and self._is_create and self._begin_depth > 0:
+        if kind in ('IF', 'WHILE') and self._is_create and self._begin_depth > 0:
             # if unified == 'CASE':
             #     self._in_case = True
-            if unified == 'WHILE':
+            if kind == 'WHILE':
                 self._inwhile = True
             return 1
 
-        if unified == 'END CASE':
+        if kind == 'END_CASE':
             self._in_case = self._in_case - 1
             return -1
 
-        if unified in ('END IF', 'END WHILE', 'END LOOP'):
+        if kind == 'END_BLOCK':
             return -1
 
         # Default
@@ -137,17 +164,27 @@ class StatementSplitter(object):
 
         for ttype, value in stream:
             # start with new token
-            csl = self._change_splitlevel(ttype, value)
-            self.level += csl
+            token = sql.Token(ttype, value)
+            # only keywords change the split level, skip the checks
+            # for all other tokens
+            csl = (self._change_splitlevel(ttype, token.normalized)
+                   if token.is_keyword else 0)
+
+            if csl == 0:
+                if self.level == 0:
+                    # not within a block, the common case
+                    self.tokens.append(token)
+                else:
+                    self.append_token_at_depth(self.level, token)
+                continue
 
+            self.level += csl
             if csl == 1:
                 self.add_new_token_array_at(self.level)
-                self.append_token_at_depth(self.level, sql.Token(ttype, value))
-            elif csl == -1:
-                self.append_token_at_depth(self.level + 1, sql.Token(ttype, value))
-                self.process_list_at_depth(self.level + 1)
+                self.append_token_at_depth(self.level, token)
             else:
-                self.append_token_at_depth(self.level, sql.Token(ttype, value))
+                self.append_token_at_depth(self.level + 1, token)
+                self.process_list_at_depth(self.level + 1)
         while self.level > 0:
             self.level += -1
             self.process_list_at_depth(self.level + 1)
@@ -157,26 +194,18 @@ class StatementSplitter(object):
 
     # Add a new array list
     def add_new_token_array_at(self, depth):
-        temp = self.tokens
-        for i in range(depth):
-            if i < depth - 1:
-                temp = temp[len(temp) - 1]
-            else:
-                temp.append([])
+        if depth > 0:
+            new = []
+            self._stack[depth - 1].append(new)
+            del self._stack[depth:]
+            self._stack.append(new)
 
     def append_token_at_depth(self, depth, token):
-        temp = self.tokens
-        for i in range(depth + 1):
-            if i < depth:
-                temp = temp[len(temp) - 1]
-            else:
-                temp.append(token)
+        if depth >= 0:
+            self._stack[depth].append(token)
 
     def process_list_at_depth(self, depth):
-        temp = self.tokens
-        for i in range(depth):
-            if i < depth - 1:
-                temp = temp[len(temp) - 1]
-            else:
-                temp_tokenlist = sql.Statement(temp.pop())
-                temp.append(temp_tokenlist)
+        if depth > 0:
+            del self._stack[depth + 1:]
+            inner = self._stack.pop()
+            self._stack[-1][-1] = sql.Statement(inner)
@@ -10,3 +10,5 @@
 
 class bsqlparseError(Exception):
     """Base class for exceptions in this module."""
+
+    __slots__ = ()
@@ -5,23 +5,32 @@
 # This module is part of python-bsqlparse and is released under
 # the BSD License: https://opensource.org/licenses/BSD-3-Clause
 
-from bsqlparse.filters.others import SerializerUnicode
-from bsqlparse.filters.others import StripCommentsFilter
-from bsqlparse.filters.others import StripWhitespaceFilter
-from bsqlparse.filters.others import SpacesAroundOperatorsFilter
+import importlib
+import sys
 
-from bsqlparse.filters.output import OutputPHPFilter
-from bsqlparse.filters.output import OutputPythonFilter
+# Filter classes are imported on first access (PEP 562) so that using
+# one filter doesn't pay for importing all of them. Accessing one class
+# binds all classes of its submodule at once.
+_MODULES = {
+    'others': ('SerializerUnicode',
+               'StripCommentsFilter',
+               'StripWhitespaceFilter',
+               'SpacesAroundOperatorsFilter'),
+    'output': ('OutputPHPFilter',
+               'OutputPythonFilter'),
+    'tokens': ('KeywordCaseFilter',
+               'IdentifierCaseFilter',
+               'TruncateStringFilter'),
+    'reindent': ('ReindentFilter',),
+    'right_margin': ('RightMarginFilter',),
+    'aligned_indent': ('AlignedIndentFilter',),
+}
 
-from bsqlparse.filters.tokens import KeywordCaseFilter
-from bsqlparse.filters.tokens import IdentifierCaseFilter
-from bsqlparse.filters.tokens import TruncateStringFilter
+_LAZY = dict((name, module)
+             for module, names in _MODULES.items()
+             for name in names)
 
-from bsqlparse.filters.reindent import ReindentFilter
-from bsqlparse.filters.right_margin import RightMarginFilter
-from bsqlparse.filters.aligned_indent import AlignedIndentFilter
-
-__all__ = [
+__all__ = (
     'SerializerUnicode',
     'StripCommentsFilter',
     'StripWhitespaceFilter',
@@ -37,4 +46,28 @@ __all__ = [
     'ReindentFilter',
     'RightMarginFilter',
     'AlignedIndentFilter',
-]
+)
+
+
+def __getattr__(name):
+    try:
+        modname = _LAZY[name]
+    except KeyError:
+        raise AttributeError(
+            'module {0!r} has no attribute {1!r}'.format(__name__, name))
+    module = importlib.import_module('bsqlparse.filters.' + modname)
+    ns = globals()
+    for cls_name in _MODULES[modname]:
+        ns[cls_name] = getattr(module, cls_name)
+    return ns[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+
+# Module level __getattr__ is only honoured by Python 3.7+.
+if sys.version_info < (3, 7):
+    for _name in __all__:
+        __getattr__(_name)
+    del _name
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+# cython: language_level=3str
 #
 # Copyright (C) 2016 Andi Albrecht, albrecht.andi@gmail.com
 #
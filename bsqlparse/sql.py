@@ -11,10 +11,69 @@ from __future__ import print_function
 import re
 
 from bsqlparse import tokens as T
+from bsqlparse._cgroup import collect_functions
 from bsqlparse.compat import string_types, text_type, unicode_compatible
-from bsqlparse.utils import imt, remove_quotes
-
-import inspect
+from bsqlparse.utils import imt, imt_predicate, remove_quotes
+
+_PATTERN_TYPE = type(re.compile(''))
+
+# Caches used by Token.match. They are cleared when they grow beyond
+# _CACHE_MAX entries.
+_CACHE_MAX = 512
+_REGEX_CACHE = {}
+_KEYWORD_CACHE = {}
+
+# (is_keyword, is_whitespace, is_comment) per token type. Token types are
+# created on first attribute access, so the flags are filled in lazily
+# instead of being computed from the type tree at import time.
+_TTYPE_FLAGS = {}
+
+
+def _compile(pattern, flags=0):
+    """Returns the compiled *pattern*, compiling it only once."""
+    key = pattern, flags
+    try:
+        return _REGEX_CACHE[key]
+    except KeyError:
+        if len(_REGEX_CACHE) >= _CACHE_MAX:
+            _REGEX_CACHE.clear()
+        regex = _REGEX_CACHE[key] = re.compile(pattern, flags)
+        return regex
+
+
+def _upper_values(values):
+    """Returns the upper-cased *values* as a frozenset."""
+    try:
+        return _KEYWORD_CACHE[values]
+    except KeyError:
+        if len(_KEYWORD_CACHE) >= _CACHE_MAX:
+            _KEYWORD_CACHE.clear()
+        upper = _KEYWORD_CACHE[values] = frozenset(v.upper() for v in values)
+        return upper
+
+
+def _collapse_ws(raw):
+    """Replaces each run of whitespace in *raw* by a single space."""
+    parts = raw.split()
+    collapsed = u' '.join(parts)
+    # str.split() drops whitespace at both ends, keep one space there
+    if raw[:1].isspace():
+        collapsed = u' ' + collapsed
+    if parts and raw[-1:].isspace():
+        collapsed += u' '
+    return collapsed
+
+
+def _ttype_flags(ttype):
+    """Returns the ``is_keyword``, ``is_whitespace`` and ``is_comment``
+    flags of tokens of type *ttype*."""
+    try:
+        return _TTYPE_FLAGS[ttype]
+    except KeyError:
+        flags = _TTYPE_FLAGS[ttype] = (ttype in T.Keyword,
+                                       ttype in T.Whitespace,
+                                       ttype in T.Comment)
+        return flags
 
 
 @unicode_compatible
@@ -27,7 +86,14 @@ class Token(object):
     """
 
     __slots__ = ('value', 'ttype', 'parent', 'normalized', 'is_keyword',
-                 'is_group', 'is_whitespace')
+                 'is_group', 'is_whitespace', 'is_comment')
+
+    # Attributes serialized by toJson()
+    _JSON_FIELDS = ('value', 'ttype', 'normalized', 'is_keyword', 'is_group',
+                    'is_whitespace')
+
+    # Slots holding caches, they are not pickled
+    _CACHE_SLOTS = frozenset(('_value', '_index'))
 
     def __init__(self, ttype, value):
         value = text_type(value)
@@ -35,13 +101,30 @@ class Token(object):
         self.ttype = ttype
         self.parent = None
         self.is_group = False
-        self.is_keyword = ttype in T.Keyword
-        self.is_whitespace = self.ttype in T.Whitespace
+        self.is_keyword, self.is_whitespace, self.is_comment = \
+            _ttype_flags(ttype)
         self.normalized = value.upper() if self.is_keyword else value
 
     def __str__(self):
         return self.value
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for key in cls.__dict__.get('__slots__', ()):
+                if key in self._CACHE_SLOTS:
+                    continue
+                # read the slot itself, TokenList shadows some by properties
+                try:
+                    state[key] = cls.__dict__[key].__get__(self)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
     # Pending tokenlist __len__ bug fix
     # def __len__(self):
     #     return len(self.value)
@@ -52,7 +135,7 @@ class Token(object):
 
         q = u'"' if value.startswith("'") and value.endswith("'") else u"'"
         return u"<{cls} {q}{value}{q} at 0x{id:2X}>".format(
-            id=id(self), **locals())
+            cls=cls, q=q, value=value, id=id(self))
 
     def _get_repr_name(self):
         return str(self.ttype).split('.')[-1]
@@ -61,7 +144,10 @@ class Token(object):
         raw = text_type(self)
         # if len(raw) > 100:
         #     raw = raw[:99] + '...'
-        return re.sub(r'\s+', ' ', raw)
+        if raw.isalnum():
+            # no whitespace to collapse, true for most keywords and names
+            return raw
+        return _collapse_ws(raw)
 
     def flatten(self):
         """Resolve subgroups."""
@@ -77,19 +163,23 @@ class Token(object):
         is returned. Except for keyword tokens the comparison is
         case-sensitive. For convenience it's ok to pass in a single string.
         If *regex* is ``True`` (default is ``False``) the given values are
-        treated as regular expressions.
+        treated as regular expressions. Compiled patterns are used as they
+        are, regardless of *ignorecase*.
         """
         type_matched = self.ttype is ttype
         if not type_matched or values is None:
             return type_matched
 
-        if isinstance(values, string_types):
+        if isinstance(values, (string_types, _PATTERN_TYPE)):
             values = (values,)
+        elif not isinstance(values, (tuple, frozenset)):
+            values = tuple(values)
 
         if regex:
             # TODO: Add test for regex with is_keyboard = false
             flag = re.IGNORECASE if self.is_keyword or ignorecase else 0
-            values = (re.compile(v, flag) for v in values)
+            values = (v if isinstance(v, _PATTERN_TYPE) else _compile(v, flag)
+                      for v in values)
 
             for pattern in values:
                 if pattern.search(self.normalized):
@@ -97,7 +187,7 @@ class Token(object):
             return False
 
         if self.is_keyword:
-            values = (v.upper() for v in values)
+            return self.normalized in _upper_values(values)
 
         return self.normalized in values
 
@@ -107,12 +197,8 @@ class Token(object):
         Use this method for example to check if an identifier is within
         a function: ``t.within(sql.Function)``.
         """
-        parent = self.parent
-        while parent:
-            if isinstance(parent, group_cls):
-                return True
-            parent = parent.parent
-        return False
+        return any(isinstance(parent, group_cls)
+                   for parent in self._ancestors())
 
     def is_child_of(self, other):
         """Returns ``True`` if this token is a direct child of *other*."""
@@ -120,39 +206,26 @@ class Token(object):
 
     def has_ancestor(self, other):
         """Returns ``True`` if *other* is in this tokens ancestry."""
-        parent = self.parent
-        while parent:
-            if parent == other:
-                return True
-            parent = parent.parent
-        return False
+        return any(parent is other for parent in self._ancestors())
 
     def get_ancestor(self, cls):
-        parent = self.parent
-        while parent:
+        """Returns the closest ancestor that is an instance of *cls*
+        or ``None``."""
+        for parent in self._ancestors():
             if isinstance(parent, cls):
                 return parent
+        return None
+
+    def _ancestors(self):
+        """Yields the groups containing this token, innermost first."""
+        parent = self.parent
+        while parent is not None:
+            yield parent
             parent = parent.parent
-        return False
 
     def toJson(self):
-        return dict(
-            (key, value)
-            for key, value in inspect.getmembers(self)
-            if not key.startswith("__")
-            and not key.startswith("parent")
-            and not key.startswith("_groupable_tokens")
-            and not key.startswith("M_OPEN")
-            and not key.startswith("M_CLOSE")
-            and not inspect.isabstract(value)
-            and not inspect.isbuiltin(value)
-            and not inspect.isfunction(value)
-            and not inspect.isgenerator(value)
-            and not inspect.isgeneratorfunction(value)
-            and not inspect.ismethod(value)
-            and not inspect.ismethoddescriptor(value)
-            and not inspect.isroutine(value)
-        )
+        """Returns a dict of the token's attributes."""
+        return dict((key, getattr(self, key)) for key in self._JSON_FIELDS)
 
 
 @unicode_compatible
@@ -163,17 +236,54 @@ class TokenList(Token):
     list of child-tokens.
     """
 
-    __slots__ = 'tokens'
+    __slots__ = ('tokens', '_value', '_index')
+
+    _JSON_FIELDS = Token._JSON_FIELDS + ('tokens',)
 
     def __init__(self, tokens=None):
         self.tokens = tokens or []
-        [setattr(token, 'parent', self) for token in tokens]
-        super(TokenList, self).__init__(None, text_type(self))
+        for token in self.tokens:
+            token.parent = self
+        # value and token positions are computed on first access
+        self._value = None
+        self._index = None
+        self.ttype = None
+        self.parent = None
         self.is_group = True
+        self.is_keyword = False
+        self.is_whitespace = False
+        self.is_comment = False
 
     def __str__(self):
         return u''.join(token.value for token in self.flatten())
 
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = text_type(self)
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    @property
+    def normalized(self):
+        return self.value
+
+    def __setstate__(self, state):
+        super(TokenList, self).__setstate__(state)
+        self._value = None
+        self._index = None
+
+    def _invalidate(self):
+        """Drops cached values of this group and its parents."""
+        self._index = None
+        token = self
+        while token is not None:
+            token._value = None
+            token = token.parent
+
     # weird bug
     # def __len__(self):
     #     return len(self.tokens)
@@ -185,6 +295,7 @@ class TokenList(Token):
         return self.tokens[item]
 
     def pop(self, index=-1):
+        self._invalidate()
         return self.tokens.pop(index)
 
     def _get_repr_name(self):
@@ -209,28 +320,9 @@ class TokenList(Token):
                 print(u"{indent}{idx:2d} {cls} {q}{value}{q}".format(**locals()), file=f)
 
     def toJson(self):
-        d = {}
-        for key, value in inspect.getmembers(self):
-            if not key.startswith("__") \
-                and not key.startswith("parent") \
-                and not key.startswith("_groupable_tokens") \
-                and not key.startswith("M_OPEN") \
-                and not key.startswith("M_CLOSE") \
-                and not inspect.isabstract(value) \
-                and not inspect.isbuiltin(value) \
-                and not inspect.isfunction(value) \
-                and not inspect.isgenerator(value) \
-                and not inspect.isgeneratorfunction(value) \
-                and not inspect.ismethod(value) \
-                and not inspect.ismethoddescriptor(value) \
-                and not inspect.isroutine(value):
-                if key == "tokens":
-                    d[key] = []
-                    for token in value:
-                        d[key].append(token.toJson())
-                else:
-                    d[key] = value
-
+        """Returns a dict of the group's attributes and child tokens."""
+        d = super(TokenList, self).toJson()
+        d['tokens'] = [token.toJson() for token in self.tokens]
         return d
 
     def get_token_at_offset(self, offset):
@@ -245,14 +337,18 @@ class TokenList(Token):
     def flatten(self):
         """Generator yielding ungrouped tokens.
 
-        This method is recursively called for all child tokens.
+        Child groups are walked with an explicit stack of iterators
+        instead of nested generators.
         """
-        for token in self.tokens:
-            if token.is_group:
-                for item in token.flatten():
-                    yield item
-            else:
+        stack = [iter(self.tokens)]
+        while stack:
+            for token in stack[-1]:
+                if token.is_group:
+                    stack.append(iter(token.tokens))
+                    break
                 yield token
+            else:
+                stack.pop()
 
     def get_sublists(self):
         for token in self.tokens:
@@ -269,20 +365,60 @@ class TokenList(Token):
             return None
 
         if not isinstance(funcs, (list, tuple)):
-            funcs = (funcs,)
-
-        if reverse:
-            assert end is None
-            for idx in range(start - 2, -1, -1):
-                token = self.tokens[idx]
-                for func in funcs:
-                    if func(token):
-                        return idx, token
+            pred = funcs
+        elif len(funcs) == 1:
+            pred = funcs[0]
         else:
-            for idx, token in enumerate(self.tokens[start:end], start=start):
+            def pred(token):
                 for func in funcs:
                     if func(token):
-                        return idx, token
+                        return True
+                return False
+
+        if reverse:
+            return self._rscan(start, pred)
+        return self._fscan(start, end, pred)
+
+    def _rscan(self, start, pred):
+        """last token before *start* - 1 that matches *pred*"""
+        tokens = self.tokens
+        for idx in range(start - 2, -1, -1):
+            token = tokens[idx]
+            if pred(token):
+                return idx, token
+        return None, None
+
+    def _fscan(self, start, end, pred):
+        """first token in tokens[start:end] that matches *pred*"""
+        tokens = self.tokens
+        # same bounds as the slice, without copying the tokens
+        for idx in range(*slice(start, end).indices(len(tokens))):
+            token = tokens[idx]
+            if pred(token):
+                return idx, token
+        return None, None
+
+    def _token_skipping(self, start, skip_ws=True, skip_cm=False,
+                        reverse=False):
+        """next token that isn't whitespace (*skip_ws*) or comment (*skip_cm*)
+
+        *start* is the first index looked at, *reverse* scans from there
+        towards the beginning.
+        """
+        tokens = self.tokens
+        if reverse:
+            indexes = range(start, -1, -1)
+        else:
+            indexes = range(start, len(tokens))
+
+        for idx in indexes:
+            token = tokens[idx]
+            if skip_ws and token.is_whitespace:
+                continue
+            # this on is inconsistent, using Comment instead of T.Comment...
+            if skip_cm and (token.is_comment or isinstance(token, Comment)):
+                continue
+            return idx, token
         return None, None
 
     def token_first(self, skip_ws=True, skip_cm=False):
@@ -294,10 +430,7 @@ class TokenList(Token):
         if *skip_cm* is ``True`` (default: ``False``), comments are
         ignored too.
         """
-        # this on is inconsistent, using Comment instead of T.Comment...
-        funcs = lambda tk: not ((skip_ws and tk.is_whitespace) or
-                                (skip_cm and imt(tk, t=T.Comment, i=Comment)))
-        return self._token_matching(funcs)[1]
+        return self._token_skipping(0, skip_ws, skip_cm)[1]
 
     def token_last(self, skip_ws=True, skip_cm=False):
         """Returns the first child token.
@@ -308,15 +441,38 @@ class TokenList(Token):
         if *skip_cm* is ``True`` (default: ``False``), comments are
         ignored too.
         """
-        # this on is inconsistent, using Comment instead of T.Comment...
-        funcs = lambda tk: not ((skip_ws and tk.is_whitespace) or
-                                (skip_cm and imt(tk, t=T.Comment, i=Comment)))
-        return self._token_matching(funcs, start=len(self.tokens) + 1, reverse=True)[1]
+        return self._token_skipping(len(self.tokens) - 1, skip_ws, skip_cm,
+                                    reverse=True)[1]
 
     def token_next_by(self, i=None, m=None, t=None, idx=-1, end=None):
-        funcs = lambda tk: imt(tk, i, m, t)
         idx += 1
-        return self._token_matching(funcs, idx, end)
+        # A single class, pattern or token type, like most calls. The
+        # check is inlined instead of calling a predicate per token.
+        if t is None and m is None and i is not None \
+                and not isinstance(i, list):
+            tokens = self.tokens
+            for idx in range(*slice(idx, end).indices(len(tokens))):
+                token = tokens[idx]
+                if isinstance(token, i):
+                    return idx, token
+            return None, None
+        if t is None and i is None and isinstance(m, tuple) and m:
+            tokens = self.tokens
+            ttype = m[0]
+            for idx in range(*slice(idx, end).indices(len(tokens))):
+                token = tokens[idx]
+                if token.ttype is ttype and token.match(*m):
+                    return idx, token
+            return None, None
+        if i is None and m is None and t is not None \
+                and not isinstance(t, list):
+            tokens = self.tokens
+            for idx in range(*slice(idx, end).indices(len(tokens))):
+                token = tokens[idx]
+                if token.ttype in t:
+                    return idx, token
+            return None, None
+        return self._token_matching(imt_predicate(i, m, t), idx, end)
 
     def token_not_matching(self, funcs, idx):
         funcs = (funcs,) if not isinstance(funcs, (list, tuple)) else funcs
@@ -345,15 +501,33 @@ class TokenList(Token):
         """
         if idx is None:
             return None, None
-        idx += 1  # alot of code usage current pre-compensates for this
-        funcs = lambda tk: not ((skip_ws and tk.is_whitespace) or
-                                (skip_cm and imt(tk, t=T.Comment, i=Comment)))
-        return self._token_matching(funcs, idx, reverse=_reverse)
+        # *idx* itself is skipped, alot of code usage current
+        # pre-compensates for this
+        idx = idx - 1 if _reverse else idx + 1
+        return self._token_skipping(idx, skip_ws, skip_cm, reverse=_reverse)
 
     def token_index(self, token, start=0):
         """Return list index of token."""
         start = start if isinstance(start, int) else self.token_index(start)
-        return start + self.tokens[start:].index(token)
+        tokens = self.tokens
+        index = self._index
+        if index:
+            idx = index.get(id(token))
+            if idx is not None and idx < len(tokens) and tokens[idx] is token:
+                return idx if idx >= start else tokens.index(token, start)
+            # stale, e.g. filters change tokens in place
+            index = None
+        idx = tokens.index(token, start)
+        if index is None:
+            # The list changed since the last lookup, and grouping changes
+            # it again right after. Only mark it as scanned (False) and
+            # build the map on a second lookup without a change. Indexing
+            # in reverse keeps the first position of each token.
+            self._index = False
+        else:
+            self._index = dict(zip(map(id, reversed(tokens)),
+                                   range(len(tokens) - 1, -1, -1)))
+        return idx
 
     def group_tokens(self, grp_cls, start, end, include_end=True,
                      extend=False):
@@ -373,15 +547,20 @@ class TokenList(Token):
             grp = start
             grp.tokens.extend(subtokens)
             del self.tokens[start_idx + 1:end_idx]
-            grp.value = text_type(start)
+            # rebuilt on first access, extending a group token by token
+            # would otherwise join its whole text on every call
+            grp._value = None
+            for token in subtokens:
+                token.parent = grp
         else:
+            # the new group sets itself as parent of the subtokens
             subtokens = self.tokens[start_idx:end_idx]
             grp = grp_cls(subtokens)
             self.tokens[start_idx:end_idx] = [grp]
             grp.parent = self
 
-        for token in subtokens:
-            token.parent = grp
+        self._index = None
+        grp._index = None
 
         return grp
 
@@ -391,6 +570,7 @@ class TokenList(Token):
             where = self.token_index(where)
         token.parent = self
         self.tokens.insert(where, token)
+        self._invalidate()
 
     def insert_after(self, where, token, skip_ws=True):
         """Inserts *token* after *where*."""
@@ -402,6 +582,7 @@ class TokenList(Token):
             self.tokens.append(token)
         else:
             self.tokens.insert(nidx, token)
+        self._invalidate()
 
     def has_alias(self):
         """Returns ``True`` if an alias is present."""
@@ -463,6 +644,7 @@ class TokenList(Token):
 
 class Statement(TokenList):
     """Represents a SQL statement."""
+    __slots__ = ()
 
     def get_type(self):
         """Returns the type of a statement.
@@ -504,6 +686,7 @@ class Identifier(TokenList):
 
     Identifiers may have aliases or typecasts.
     """
+    __slots__ = ()
 
     def is_wildcard(self):
         """Return ``True`` if this identifier contains a wildcard."""
@@ -532,6 +715,7 @@ class Identifier(TokenList):
 
 class IdentifierList(TokenList):
     """A list of :class:`~bsqlparse.sql.Identifier`\'s."""
+    __slots__ = ()
 
     def get_identifiers(self):
         """Returns the identifiers.
@@ -545,6 +729,7 @@ class IdentifierList(TokenList):
 
 class Parenthesis(TokenList):
     """Tokens between parenthesis."""
+    __slots__ = ()
     M_OPEN = T.Punctuation, '('
     M_CLOSE = T.Punctuation, ')'
 
@@ -555,12 +740,14 @@ class Parenthesis(TokenList):
 
 class OpenLoopTag(TokenList):
     """Tokens between comparisons"""
+    __slots__ = ()
     M_OPEN = T.Comparison, '<<'
     M_CLOSE = T.Comparison, '>>'
 
 
 class SquareBrackets(TokenList):
     """Tokens between square brackets"""
+    __slots__ = ()
     M_OPEN = T.Punctuation, '['
     M_CLOSE = T.Punctuation, ']'
 
@@ -571,6 +758,7 @@ class SquareBrackets(TokenList):
 
 class Assignment(TokenList):
     """An assignment like 'var := val;'"""
+    __slots__ = ()
 
     @property
     def left(self):
@@ -583,43 +771,37 @@ class Assignment(TokenList):
 
 class If(TokenList):
     """An 'if' clause with possible 'else if' or 'else' parts."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'IF'
     M_CLOSE = T.Keyword, 'END IF'
 
     def get_block(self, index):
-        block_start, start_then = self.token_next_by(m=(T.Keyword, "THEN"))
-        start_then += 1
-
-        while True:
-            nxtid, _nxttkn = self.token_next_by(m=(T.Keyword, "ELSIF"))
-            if _nxttkn:
-                if start_then <= index < nxtid:
-                    return start_then, nxtid - 1
-                else:
-                    block_start, start_then = self.token_next_by(m=(T.Keyword, "THEN"))
-                    start_then += 1
-                    continue
-
-            nxtid, _nxttkn = self.token_next_by(m=(T.Keyword, "ELSE"))
-            if _nxttkn:
-                if start_then <= index < nxtid:
-                    return start_then, nxtid - 1
-                else:
-                    start_then += 1
-                    continue
-
-            nxtid, _nxttkn = self.token_next_by(m=(T.Keyword, "END IF"))
-            if _nxttkn:
-                if start_then <= index < nxtid:
-                    return start_then, nxtid - 1
-                else:
-                    break
-
+        """Returns the first and last index of the branch containing the
+        token at *index* or ``(None, None)``."""
+        for start, end in self._blocks():
+            if start <= index <= end:
+                return start, end
         return None, None
 
+    def _blocks(self):
+        """Index ranges of the branch bodies, found in a single pass."""
+        blocks = []
+        start = None
+        for idx, token in enumerate(self.tokens):
+            if token.ttype not in T.Keyword:
+                continue
+            if token.normalized in ('ELSIF', 'ELSE', 'END IF'):
+                if start is not None:
+                    blocks.append((start, idx - 1))
+                start = idx + 1 if token.normalized == 'ELSE' else None
+            elif token.normalized == 'THEN':
+                start = idx + 1
+        return blocks
+
 
 class Select(TokenList):
     """An 'select' clause within packages ending with ';'."""
+    __slots__ = ()
     M_OPEN = T.Keyword.DML, 'SELECT'
     M_CLOSE = [(T.Punctuation, ';'), (T.Keyword, 'UNION'), (T.Keyword, 'UNION ALL')]
 
@@ -655,12 +837,14 @@ class Select(TokenList):
 
 class DML_Operation(TokenList):
     """An 'select' clause within packages ending with ';'."""
+    __slots__ = ()
     M_OPEN = T.Keyword.DML, ('INSERT', 'UPDATE', 'DELETE')
     M_CLOSE = T.Punctuation, ';'
 
 
 class Package(TokenList):
     """ Package """
+    __slots__ = ()
 
     @property
     def fp(self):
@@ -703,6 +887,7 @@ class Package(TokenList):
 
 class PackageHeading(TokenList):
     """ Procedure Heading Class """
+    __slots__ = ()
     M_OPEN = T.Keyword.DDL, "CREATE OR REPLACE"
     M_NEXT = T.Keyword, "PACKAGE"
     M_CLOSE = T.Keyword, ('IS', 'AS')
@@ -710,6 +895,7 @@ class PackageHeading(TokenList):
 
 class FunctionHeading(TokenList):
     """Group procedure and function."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'FUNCTION', False, True
     M_CLOSE = [(T.Keyword, ('IS', 'AS')), (T.Punctuation, ';'), (T.Punctuation, ','), ]
 
@@ -727,6 +913,7 @@ class FunctionHeading(TokenList):
 
 class ProcedureHeading(TokenList):
     """A function or procedure call."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'PROCEDURE', False, True
 
     def get_parameters(self):
@@ -743,6 +930,7 @@ class ProcedureHeading(TokenList):
 
 
 class FunctionParam(TokenList):
+    __slots__ = ('param_name', 'in_', 'out_', 'nocopy_', 'data_type_')
     SEPARATOR = T.Punctuation, ","
     """ Group each params of function """
 
@@ -753,7 +941,16 @@ class FunctionParam(TokenList):
         self.nocopy_ = None
         self.data_type_ = None
         temp_i = 0
-        for i, token in enumerate(self.flatten()):
+        # flatten once, the positions below index into the same walk
+        flat = list(self.flatten())
+
+        def direct_child(token):
+            # climb up to the child token of this param
+            while token.parent and token.parent is not self:
+                token = token.parent
+            return token
+
+        for i, token in enumerate(flat):
             if not token.is_whitespace:
                 if not self.param_name:
                     temp_i = i
@@ -772,38 +969,22 @@ class FunctionParam(TokenList):
                     self.nocopy_ = token
                     continue
                 if not self.data_type_ and imt(token, m=[(T.Keyword, 'DEFAULT')], t=T.Assignment):
-                    _start = list(self.flatten())[temp_i + 2]
-                    while _start.parent:
-                        if _start.parent == self:
-                            break
-                        else:
-                            _start = _start.parent
-
-                    _end = list(self.flatten())[i - 2]
-                    while _end.parent:
-                        if _end.parent == self:
-                            break
-                        else:
-                            _end = _end.parent
-
+                    _start = direct_child(flat[temp_i + 2])
+                    _end = direct_child(flat[i - 2])
                     self.data_type_ = self.tokens[self.token_index(_start):self.token_index(_end) + 1]
-                    # self.data_type_ = list(self.flatten())[temp_i + 2:i - 1]
-                    # self.data_type_ = list(self.flatten())[i-1]
+                    # self.data_type_ = flat[temp_i + 2:i - 1]
+                    # self.data_type_ = flat[i-1]
         if not self.data_type_:
             # Go to param
-            _param = list(self.flatten())[temp_i + 2]
-            while _param.parent:
-                if _param.parent == self:
-                    break
-                else:
-                    _param = _param.parent
+            _param = direct_child(flat[temp_i + 2])
             self.data_type_ = self.tokens[self.token_index(_param): len(self.tokens) + 1]
-            # self.data_type_ = list(self.flatten())[temp_i + 2:i + 1]
-            # self.data_type_ = list(self.flatten())[i]
+            # self.data_type_ = flat[temp_i + 2:i + 1]
+            # self.data_type_ = flat[i]
 
 
 class DeclareSection(TokenList):
     """ function declare section """
+    __slots__ = ()
     M_OPEN = T.Keyword, ('IS', 'AS')
     SEPARATOR = T.Punctuation, ';'
 
@@ -832,6 +1013,7 @@ class DeclareSection(TokenList):
 
 class DataType(TokenList):
     """ Param Data type"""
+    __slots__ = ()
 
     def get_name(self):
         first = self.token_first(skip_cm=True)
@@ -852,8 +1034,10 @@ class DataType(TokenList):
 
 class For(TokenList):
     """A 'FOR' loop."""
+    __slots__ = ()
     # M_OPEN = T.Keyword, ('FOR', 'FOREACH')
-    M_OPEN = [(T.ForIn, r'FOR\s+\w+\s+IN\b', True), (T.Keyword, 'LOOP')]
+    M_OPEN = [(T.ForIn, re.compile(r'FOR\s+\w+\s+IN\b', re.IGNORECASE), True),
+              (T.Keyword, 'LOOP')]
     M_CLOSE = T.Keyword, 'END LOOP'
 
     @property
@@ -867,6 +1051,7 @@ class For(TokenList):
 
 class Comparison(TokenList):
     """A comparison used for example in WHERE clauses."""
+    __slots__ = ()
 
     @property
     def left(self):
@@ -879,6 +1064,7 @@ class Comparison(TokenList):
 
 class Comment(TokenList):
     """A comment."""
+    __slots__ = ()
 
     def is_multiline(self):
         return self.tokens and self.tokens[0].ttype == T.Comment.Multiline
@@ -886,6 +1072,7 @@ class Comment(TokenList):
 
 class Block(TokenList):
     """ Parent for function and procedure block"""
+    __slots__ = ('referenced_by',)
 
     def __init__(self, tokens=None):
         super(Block, self).__init__(tokens)
@@ -893,27 +1080,24 @@ class Block(TokenList):
 
     @property
     def references(self):
+        """The functions called in the block's BEGIN section.
+
+        A block without BEGIN (e.g. a forward declaration) has none.
+        """
         _beginidx, _begintkn = self.token_next_by(i=Begin)
-        _flist = self._get_all_functions(_begintkn.get_sublists())
-        return _flist
+        if _begintkn is None:
+            return []
+        return self._get_all_functions(_begintkn.get_sublists())
 
     def _get_all_functions(self, l):
-        fl = []
-        _package = self.get_ancestor(Package)
-        for su in l:
-            if isinstance(su, Function):
-                if isinstance(su.parent, Identifier):
-                    fl.append(su.parent)
-                elif su.name in _package.fpn:
-                    fl.append(su)
-            elif isinstance(su, Identifier) and isinstance(su.parent, (If, For, Begin)):
-                fl.append(su)
-            fl += self._get_all_functions(su.get_sublists())
-        return list(set(fl))
+        """Returns the called functions found below the groups in *l*."""
+        return collect_functions(l, Function, Identifier, (If, For, Begin),
+                                 lambda: self.get_ancestor(Package).fpn)
 
 
 class FunctionBlock(Block):
     """ A function block """
+    __slots__ = ()
 
     def get_my_name(self):
         fhid, fhtk = self.token_next_by(i=FunctionHeading)
@@ -930,6 +1114,7 @@ class FunctionBlock(Block):
 
 class ProcedureBlock(Block):
     """ A procedure block """
+    __slots__ = ()
 
     def get_my_name(self):
         phid, phtk = self.token_next_by(i=ProcedureHeading)
@@ -946,20 +1131,28 @@ class ProcedureBlock(Block):
 
 class Where(TokenList):
     """A WHERE clause."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'WHERE'
-    M_CLOSE = T.Keyword, ('ORDER', 'GROUP', 'LIMIT', 'UNION', 'EXCEPT',
-                          'HAVING', 'RETURNING', 'INTO', 'FOR UPDATE')
+    M_CLOSE = T.Keyword, frozenset(('ORDER', 'GROUP', 'LIMIT', 'UNION',
+                                    'EXCEPT', 'HAVING', 'RETURNING', 'INTO',
+                                    'FOR UPDATE'))
 
 
 class Union(TokenList):
     """A WHERE clause."""
-    M_DIVIDER = T.Keyword, ('UNION', 'UNION ALL')
+    __slots__ = ()
+    M_DIVIDER = T.Keyword, frozenset(('UNION', 'UNION ALL'))
 
 
 class Case(TokenList):
     """A CASE statement with one or more WHEN and possibly an ELSE part."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'CASE'
-    M_CLOSE = T.Keyword, ('END', 'END CASE')
+    M_CLOSE = T.Keyword, frozenset(('END', 'END CASE'))
+
+    # Keywords switching the mode in get_cases
+    _KEYWORDS = {'CASE': 'case', 'WHEN': 'when', 'THEN': 'then',
+                 'ELSE': 'else', 'END': 'end'}
 
     def get_cases(self, skip_ws=False):
         """Returns a list of 2-tuples (condition, value).
@@ -971,46 +1164,60 @@ class Case(TokenList):
 
         ret = []
         mode = CONDITION
-
-        for token in self.tokens:
-            # Set mode from the current statement
-            if token.match(T.Keyword, 'CASE'):
-                continue
-
-            elif skip_ws and token.ttype in T.Whitespace:
-                continue
-
-            elif token.match(T.Keyword, 'WHEN'):
+        keywords = self._KEYWORDS
+        keyword = T.Keyword
+        tokens = self.tokens
+        if skip_ws:
+            tokens = [token for token in tokens if not token.is_whitespace]
+        n = len(tokens)
+
+        # Positions of the keywords switching the mode. The tokens from
+        # one to the next share a mode and are added as a slice.
+        marks = [idx for idx, token in enumerate(tokens)
+                 if token.ttype is keyword and token.normalized in keywords]
+        marks.append(n)
+
+        start = 0
+        for end in marks:
+            segment = tokens[start:end]
+
+            # Append tokens depending of the current mode, the first
+            # condition may come without preceding WHEN
+            if mode and segment:
+                if not ret:
+                    ret.append(([], []))
+                ret[-1][mode - 1].extend(segment)
+
+            if end == n:
+                break
+
+            # Set mode from the keyword
+            action = keywords[tokens[end].normalized]
+            start = end
+            if action == 'case':
+                start += 1
+
+            elif action == 'when':
                 ret.append(([], []))
                 mode = CONDITION
 
-            elif token.match(T.Keyword, 'THEN'):
+            elif action == 'then':
                 mode = VALUE
 
-            elif token.match(T.Keyword, 'ELSE'):
+            elif action == 'else':
                 ret.append((None, []))
                 mode = VALUE
 
-            elif token.match(T.Keyword, 'END'):
+            elif action == 'end':
                 mode = None
 
-            # First condition without preceding WHEN
-            if mode and not ret:
-                ret.append(([], []))
-
-            # Append token depending of the current mode
-            if mode == CONDITION:
-                ret[-1][0].append(token)
-
-            elif mode == VALUE:
-                ret[-1][1].append(token)
-
         # Return cases list
         return ret
 
 
 class Function(TokenList):
     """A function or procedure call."""
+    __slots__ = ()
 
     @property
     def name(self):
@@ -1024,23 +1231,31 @@ class Function(TokenList):
         #     if not (token.is_whitespace or token.match(T.Punctuation, ',')):
         #         params.append(token)
         for token in parenthesis.tokens[1:-1]:
-            if isinstance(token, IdentifierList):
+            if token.is_whitespace:
+                continue
+            elif isinstance(token, IdentifierList):
                 return token.get_identifiers()
-            elif imt(token, i=(Function, Identifier, FunctionParam), t=T.Literal):
+            elif isinstance(token, _PARAM_CLASSES) or token.ttype in T.Literal:
                 return [token, ]
         return []
         # return params
 
 
+# Groups taken as the single parameter of a function
+_PARAM_CLASSES = (Function, Identifier, FunctionParam)
+
+
 class Begin(TokenList):
     """A BEGIN/END block."""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'BEGIN'
     M_CLOSE = T.Keyword, 'END'
 
 
 class Transaction(TokenList):
     """ A transaction block """
-    M_CLOSE = T.Keyword.DML, ('COMMIT', 'ROLLBACK', 'ROLLBACK TO')
+    __slots__ = ()
+    M_CLOSE = T.Keyword.DML, frozenset(('COMMIT', 'ROLLBACK', 'ROLLBACK TO'))
 
     # def __init__(self, tokens=None):
     #     super(Transaction, self).__init__(tokens)
@@ -1100,6 +1315,7 @@ class Transaction(TokenList):
 
 class Operation(TokenList):
     """Grouping of operations"""
+    __slots__ = ()
 
     @property
     def left(self):
@@ -1116,33 +1332,56 @@ class Operation(TokenList):
 
 class ReturnType(TokenList):
     """ Grouping return and return type """
+    __slots__ = ()
     M_OPEN = T.Keyword, 'RETURN'
 
 
 class CursorDef(TokenList):
+    __slots__ = ()
     M_OPEN = T.Keyword, 'CURSOR'
     M_MIDDLE = T.Keyword, 'IS'
 
 
 class Exceptions(TokenList):
+    __slots__ = ()
     M_OPEN = T.Keyword, 'EXCEPTION'
     M_CLOSE = T.Keyword, 'END'
 
 
 class Exit(TokenList):
     """Tokens between comparisons"""
+    __slots__ = ()
     M_OPEN = T.Keyword, 'EXIT'
     M_CLOSE = T.Punctuation, ';'
 
     class Condition(TokenList):
         """Grouping of Conditions inside"""
+        __slots__ = ()
 
     def group_condition(self):
-        _when_idx, _when_tkn = self.token_next_by(m=(T.Keyword, "WHEN"))
-        if _when_tkn:
-            _start = self.token_next(idx=_when_idx, skip_cm=True, skip_ws=True)[0]
-            _end = self.token_index(self.token_last(skip_cm=True))
-            self.group_tokens(self.Condition, start=_start, end=_end, include_end=False)
+        """Groups the tokens between WHEN and the closing token.
+
+        Whitespace and comments around the condition are left out.
+        """
+        tokens = self.tokens
+        n = len(tokens)
+        keyword = T.Keyword
+        idx = 0
+        while idx < n and not (tokens[idx].ttype is keyword
+                               and tokens[idx].normalized == 'WHEN'):
+            idx += 1
+        idx += 1
+        while idx < n and (tokens[idx].is_whitespace
+                           or tokens[idx].is_comment
+                           or isinstance(tokens[idx], Comment)):
+            idx += 1
+        end = n - 1
+        while end > idx and (tokens[end].is_whitespace
+                             or tokens[end].is_comment
+                             or isinstance(tokens[end], Comment)):
+            end -= 1
+        if idx < end:
+            self.group_tokens(self.Condition, idx, end, include_end=False)
 
     @property
     def condition(self):
@@ -1150,11 +1389,13 @@ class Exit(TokenList):
 
 
 class Open(TokenList):
+    __slots__ = ()
     M_OPEN = T.Keyword, 'OPEN'
     M_CLOSE = T.Punctuation, ';'
 
 
 class NotFound(TokenList):
     """Tokens between comparisons"""
+    __slots__ = ()
     M_OPEN = T.Operator, '%'
-    M_CLOSE = [(T.Keyword, 'FOUND'), (T.Keyword, 'NOTFOUND'), (T.Keyword, 'ROWCOUNT')]
+    M_CLOSE = T.Keyword, frozenset(('FOUND', 'NOTFOUND', 'ROWCOUNT'))
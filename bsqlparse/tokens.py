@@ -31,6 +31,18 @@ class _TokenType(tuple):
     def __call__(self, *args, **kwargs):
         pass
 
+    def __reduce__(self):
+        # Token types are compared by identity, unpickle to the shared one.
+        return _get_ttype, (tuple(self),)
+
+
+def _get_ttype(names):
+    """Returns the token type for the tuple of *names*."""
+    ttype = Token
+    for name in names:
+        ttype = getattr(ttype, name)
+    return ttype
+
 
 Token = _TokenType()
 
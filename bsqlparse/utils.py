@@ -69,10 +69,18 @@ def recurse(*cls):
     """
     def wrap(f):
         def wrapped_f(self, tlist):
-            for sgroup in tlist.get_sublists():
-                if not isinstance(sgroup, cls):
-                    wrapped_f(self, sgroup)
-            f(self, tlist)
+            # explicit stack instead of recursion: each entry is a group and
+            # its pending sublists, a group is handled after all of them
+            stack = [(tlist, tlist.get_sublists())]
+            while stack:
+                group, sublists = stack[-1]
+                for sgroup in sublists:
+                    if not isinstance(sgroup, cls):
+                        stack.append((sgroup, sgroup.get_sublists()))
+                        break
+                else:
+                    stack.pop()
+                    f(self, group)
 
         return wrapped_f
 
@@ -103,6 +111,33 @@ def imt(token, i=None, m=None, t=None):
         return False
 
 
+def imt_predicate(i=None, m=None, t=None):
+    """Returns a function ``f(token)`` equal to ``imt(token, i, m, t)``.
+
+    The arguments are normalized once, which pays off when many tokens
+    are checked against them.
+    """
+    clss = tuple(i) if isinstance(i, list) else i
+    mpatterns = (m if isinstance(m, list) else [m, ]) if m else ()
+    types = (t if isinstance(t, list) else [t, ]) if t else ()
+
+    def predicate(token):
+        if token is None:
+            return False
+        elif clss and isinstance(token, clss):
+            return True
+        ttype = token.ttype
+        for pattern in mpatterns:
+            # match() fails unless the token type is the very same
+            if ttype is pattern[0] and token.match(*pattern):
+                return True
+        for ttypes in types:
+            if ttype in ttypes:
+                return True
+        return False
+    return predicate
+
+
 def consume(iterator, n):
     """Advance the iterator n-steps ahead. If n is none, consume entirely."""
     deque(itertools.islice(iterator, n), maxlen=0)
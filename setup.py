@@ -6,10 +6,42 @@
 # This setup script is part of python-bsqlparse and is released under
 # the BSD License: https://opensource.org/licenses/BSD-3-Clause
 
+import os
 import re
 
 from setuptools import setup, find_packages
 
+try:
+    from Cython.Build import cythonize
+    HAS_CYTHON = True
+except ImportError:
+    HAS_CYTHON = False
+
+try:
+    from mypyc.build import mypycify
+    HAS_MYPYC = True
+except ImportError:
+    HAS_MYPYC = False
+
+# Modules that can be compiled with Cython without source changes.
+# Compilation is opt-in: set BSQLPARSE_CYTHON=1 when building.
+CYTHON_MODULES = [
+    'bsqlparse/_cgroup.py',
+    'bsqlparse/engine/grouping_class.py',
+    'bsqlparse/filters/others.py',
+    'bsqlparse/filters/output.py',
+    'bsqlparse/filters/tokens.py',
+    'bsqlparse/filters/reindent.py',
+    'bsqlparse/filters/right_margin.py',
+    'bsqlparse/filters/aligned_indent.py',
+]
+
+# Modules with type comments that mypyc can compile, an alternative to
+# Cython for them. Opt-in: set BSQLPARSE_MYPYC=1 when building.
+MYPYC_MODULES = [
+    'bsqlparse/_cgroup.py',
+]
+
 
 def get_version():
     """Parse __init__.py for version number instead of importing the file."""
@@ -23,6 +55,15 @@ def get_version():
     raise RuntimeError('Unable to find version in {fn}'.format(fn=VERSIONFILE))
 
 
+def get_ext_modules():
+    """Return the Cython or mypyc extensions to build, if any."""
+    if HAS_MYPYC and os.environ.get('BSQLPARSE_MYPYC'):
+        return mypycify(['--follow-imports=skip'] + MYPYC_MODULES)
+    if not (HAS_CYTHON and os.environ.get('BSQLPARSE_CYTHON')):
+        return []
+    return cythonize(CYTHON_MODULES)
+
+
 LONG_DESCRIPTION = """
 ``bsqlparse`` is a non-validating SQL parser module.
 It provides support for parsing, splitting and formatting SQL statements.
@@ -100,6 +141,7 @@ setup(
         'Topic :: Software Development',
     ],
     packages=find_packages(exclude=('tests',)),
+    ext_modules=get_ext_modules(),
     entry_points={
         'console_scripts': [
             'sqlformat = bsqlparse.__main__:main',
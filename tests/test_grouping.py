@@ -538,3 +538,134 @@ def test_aliased_literal_without_as():
     p = bsqlparse.parse('1 foo')[0].tokens
     assert len(p) == 1
     assert p[0].get_alias() == 'foo'
+
+
+def test_if_get_block():
+    p = bsqlparse.parse('CREATE OR REPLACE PACKAGE BODY pkg IS '
+                        'PROCEDURE p IS BEGIN '
+                        'IF a > 1 THEN v := 2; ELSIF a < 0 THEN v := 3; '
+                        'ELSE v := 4; END IF; END p; END pkg;')[0]
+    elsif = [t for t in p.flatten() if t.normalized == 'ELSIF'][0]
+    if_ = elsif.parent
+    assert isinstance(if_, sql.If)
+    blocks = [if_.get_block(i) for i, t in enumerate(if_.tokens)
+              if isinstance(t, sql.Assignment)]
+    assert [''.join(str(t) for t in if_.tokens[start:end + 1]).strip()
+            for start, end in blocks] == ['v := 2;', 'v := 3;', 'v := 4;']
+    assert if_.get_block(0) == (None, None)
+
+
+def test_if_get_block_follows_direct_edits():
+    p = bsqlparse.parse('CREATE OR REPLACE PACKAGE BODY pkg IS '
+                        'PROCEDURE p IS BEGIN '
+                        'IF a > 1 THEN v := 2; ELSIF a < 0 THEN v := 3; '
+                        'ELSE v := 4; END IF; END p; END pkg;')[0]
+    else_ = [t for t in p.flatten() if t.normalized == 'ELSE'][0]
+    if_ = else_.parent
+    idx = if_.token_index(else_)
+    assert if_.get_block(idx - 1)[1] == idx - 1
+    # without the ELSE the ELSIF branch runs up to END IF
+    if_.tokens[idx] = sql.Token(T.Name, 'x')
+    end_if = [t for t in if_.tokens if t.normalized == 'END IF'][0]
+    assert if_.get_block(idx - 1)[1] == if_.token_index(end_if) - 1
+
+
+def test_block_references_in_order():
+    p = bsqlparse.parse('CREATE OR REPLACE PACKAGE BODY pkg IS '
+                        'FUNCTION f(a NUMBER) RETURN NUMBER IS '
+                        'BEGIN RETURN a; END; '
+                        'PROCEDURE p(x NUMBER) IS BEGIN v := f(x); '
+                        'IF f(1) > 0 THEN z := y.f(3); END IF; END p; '
+                        'END pkg;')[0]
+    block = [t for t in p.flatten() if t.normalized == 'PROCEDURE'][0]
+    block = block.get_ancestor(sql.ProcedureBlock)
+    assert [str(ref) for ref in block.references] == ['f(x)', 'f(1)',
+                                                      'y.f(3)']
+
+
+def test_block_references_follow_direct_edits():
+    p = bsqlparse.parse('CREATE OR REPLACE PACKAGE BODY pkg IS '
+                        'FUNCTION f(a NUMBER) RETURN NUMBER IS '
+                        'BEGIN RETURN a; END; '
+                        'PROCEDURE p(x NUMBER) IS BEGIN v := f(x); '
+                        'v := f(2); END p; END pkg;')[0]
+    block = [t for t in p.flatten() if t.normalized == 'PROCEDURE'][0]
+    block = block.get_ancestor(sql.ProcedureBlock)
+    assert [str(ref) for ref in block.references] == ['f(x)', 'f(2)']
+    begin = block.token_next_by(i=sql.Begin)[1]
+    assignment = [t for t in begin.tokens if isinstance(t, sql.Assignment)
+                  and 'f(x)' in str(t)][0]
+    begin.tokens.remove(assignment)
+    assert [str(ref) for ref in block.references] == ['f(2)']
+
+
+def test_block_name_follows_direct_edits():
+    p = bsqlparse.parse('CREATE OR REPLACE PACKAGE BODY pkg IS '
+                        'PROCEDURE p IS BEGIN v := 1; END p; END pkg;')[0]
+    block = [t for t in p.flatten() if t.normalized == 'PROCEDURE'][0]
+    block = block.get_ancestor(sql.ProcedureBlock)
+    assert block.get_my_name() == 'p'
+    heading = block.token_next_by(i=sql.ProcedureHeading)[1]
+    heading.tokens[-1].value = 'q'
+    assert block.get_my_name() == 'q'
+
+
+def test_exit_group_condition():
+    p = bsqlparse.parse('BEGIN LOOP x := 1; '
+                        'EXIT WHEN x > 1 /* done */; END LOOP; END;')[0]
+    exit_ = [t for t in p.flatten() if t.normalized == 'EXIT'][0].parent
+    assert isinstance(exit_, sql.Exit)
+    assert exit_.condition is None
+    exit_.group_condition()
+    assert str(exit_.condition) == 'x > 1 /* done */'
+    assert str(exit_) == 'EXIT WHEN x > 1 /* done */;'
+
+
+def test_case_get_cases():
+    p = bsqlparse.parse('select case x when 1 then a '
+                        'when 2 then b else c end')[0]
+    case = p.tokens[-1]
+    assert isinstance(case, sql.Case)
+
+    def text(tokens):
+        return None if tokens is None else ''.join(str(t) for t in tokens)
+
+    assert [(text(cond), text(value)) for cond, value in case.get_cases()] \
+        == [(' x ', ''), ('when 1 ', 'then a '), ('when 2 ', 'then b '),
+            (None, 'else c ')]
+    assert [(text(cond), text(value))
+            for cond, value in case.get_cases(skip_ws=True)] \
+        == [('x', ''), ('when1', 'thena'), ('when2', 'thenb'),
+            (None, 'elsec')]
+
+
+def test_block_references_without_begin():
+    block = sql.ProcedureBlock([sql.Token(T.Keyword, 'PROCEDURE')])
+    assert block.references == []
+
+
+def test_identifier_list_value_after_extend():
+    values = ', '.join(str(i) for i in range(50))
+    p = bsqlparse.parse('select * from t where x in ({0})'.format(values))[0]
+    ilist = p.tokens[-1].tokens[-1].tokens[1]
+    assert isinstance(ilist, sql.IdentifierList)
+    assert ilist.value == values
+    assert len(list(ilist.get_identifiers())) == 50
+
+
+def test_exceptions_end_before_end():
+    p = bsqlparse.parse('begin x := 1; exception when others then null; '
+                        'end;')[0]
+    begin = p.tokens[0]
+    exc = begin.token_next_by(i=sql.Exceptions)[1]
+    assert str(exc) == 'exception when others then null;'
+    assert begin.token_next(begin.token_index(exc))[1].normalized == 'END'
+
+
+def test_grouping_deeply_nested_parenthesis():
+    s = 'select {0}a + 1{1}'.format('(' * 2000, ')' * 2000)
+    p = bsqlparse.parse(s)[0]
+    assert str(p) == s
+    name = [t for t in p.flatten() if t.value == 'a'][0]
+    assert isinstance(name.parent, sql.Operation)
+    assert isinstance(name.parent.parent, sql.Parenthesis)
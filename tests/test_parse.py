@@ -2,11 +2,14 @@
 
 """Tests bsqlparse.parse()."""
 
+import pickle
+
 import pytest
 
 import bsqlparse
-from bsqlparse import sql, tokens as T
+from bsqlparse import engine, sql, tokens as T
 from bsqlparse.compat import StringIO, text_type
+from bsqlparse.engine import filter_stack
 
 
 def test_parse_tokenize():
@@ -386,6 +389,171 @@ def test_stmt_tokens_parents():
         assert token.has_ancestor(stmt)
 
 
+def test_tokenlist_value_follows_changes():
+    stmt = bsqlparse.parse('select a from b')[0]
+    assert stmt.value == 'select a from b'
+    stmt.insert_before(0, sql.Token(T.Comment.Single, '-- x\n'))
+    assert stmt.value == '-- x\nselect a from b'
+    stmt.pop(0)
+    assert stmt.value == stmt.normalized == 'select a from b'
+
+
+def test_identifier_name_follows_changes():
+    ident = bsqlparse.parse('select foo bar')[0].tokens[-1]
+    assert ident.get_alias() == 'bar'
+    ident.pop()
+    ident.pop()
+    assert ident.get_alias() is None
+    assert ident.get_name() == 'foo'
+
+
+def test_identifier_name_follows_leaf_edits():
+    ident = bsqlparse.parse('select foo bar from t')[0].tokens[2]
+    assert ident.get_alias() == ident.get_name() == 'bar'
+    ident.tokens[-1].value = 'baz'
+    assert ident.get_alias() == ident.get_name() == 'baz'
+
+
+def test_identifier_name_follows_replaced_tokens():
+    ident = bsqlparse.parse('select a.b')[0].tokens[-1]
+    assert ident.get_real_name() == 'b'
+    assert ident.get_parent_name() == 'a'
+    ident.tokens[1] = sql.Token(T.Whitespace, ' ')
+    assert ident.get_real_name() == 'a'
+    assert ident.get_parent_name() is None
+
+
+def test_statement_type_follows_leaf_edits():
+    stmt = bsqlparse.parse('select a from b')[0]
+    assert stmt.get_type() == 'SELECT'
+    stmt.tokens[0].value = stmt.tokens[0].normalized = 'UPDATE'
+    assert stmt.get_type() == 'UPDATE'
+
+
+def test_token_index_follows_direct_edits():
+    stmt = bsqlparse.parse('select a, b from t')[0]
+    tokens = list(stmt.tokens)
+    for _ in range(2):
+        assert [stmt.token_index(t) for t in tokens] == list(
+            range(len(tokens)))
+    first = stmt.tokens.pop(0)
+    stmt.tokens.append(first)
+    assert stmt.token_index(first) == len(tokens) - 1
+    assert stmt.token_index(tokens[1]) == 0
+    with pytest.raises(ValueError):
+        stmt.token_index(tokens[1], 1)
+
+
+def test_within_follows_regrouping():
+    stmt = bsqlparse.parse('select foo')[0]
+    foo = stmt.tokens[-1]
+    assert not foo.within(sql.Parenthesis)
+    stmt.group_tokens(sql.Parenthesis, 2, 2)
+    assert foo.within(sql.Parenthesis)
+    assert foo.within(sql.TokenList)
+    assert foo.get_ancestor(sql.Parenthesis) is stmt.tokens[-1]
+
+
+def test_within_follows_direct_parent_edits():
+    stmt = bsqlparse.parse('select foo')[0]
+    foo = stmt.tokens[-1]
+    assert foo.within(sql.Statement)
+    foo.parent = None
+    assert not foo.within(sql.Statement)
+    assert not foo.has_ancestor(stmt)
+
+
+def test_pickle_statement():
+    stmt = bsqlparse.parse('select a as b from c where d = 1')[0]
+    copy = pickle.loads(pickle.dumps(stmt, 2))
+    assert str(copy) == str(stmt)
+    assert copy.tokens[0].ttype is T.Keyword.DML
+    assert copy.tokens[2].parent is copy
+    assert copy.tokens[2].get_name() == 'b'
+
+
+@pytest.fixture
+def parse_cache():
+    bsqlparse.enable_parse_cache()
+    yield bsqlparse._parse_cache
+    bsqlparse.disable_parse_cache()
+
+
+def test_parse_not_cached_by_default():
+    assert bsqlparse._parse_cache is None
+
+
+def test_parse_repeated_returns_new_tree(parse_cache):
+    sql = 'select a, b from t where c = 1'
+    first = bsqlparse.parse(sql)[0]
+    first.tokens.pop()
+    # from the cache
+    second = bsqlparse.parse(sql)[0]
+    assert second is not first
+    assert str(second) == sql
+    assert all(token.parent is second for token in second.tokens)
+
+
+def test_parse_cache_drops_least_recently_used(parse_cache):
+    sqls = ['select a', 'select b', 'select c']
+    bsqlparse.parse(sqls[0])
+    parse_cache.maxbytes = parse_cache.nbytes * 2
+    bsqlparse.parse(sqls[1])
+    bsqlparse.parse(sqls[0])
+    bsqlparse.parse(sqls[2])
+    assert list(parse_cache._blobs) == [(sqls[0], None), (sqls[2], None)]
+    assert parse_cache.nbytes <= parse_cache.maxbytes
+    bsqlparse.clear_parse_cache()
+    assert not parse_cache._blobs and parse_cache.nbytes == 0
+
+
+def test_parse_deeply_nested_not_cached(parse_cache):
+    # too deep to pickle, the result isn't cached but still returned
+    sql = 'select {0}a{1}'.format('(' * 300, ')' * 300)
+    assert str(bsqlparse.parse(sql)[0]) == sql
+    assert str(bsqlparse.parse(sql)[0]) == sql
+    assert not parse_cache._blobs
+
+
+needs_pool = pytest.mark.skipif(filter_stack.ProcessPoolExecutor is None,
+                                reason='concurrent.futures is not available')
+
+
+@needs_pool
+@pytest.mark.parametrize('chunksize', [1, 2])
+def test_run_many_with_workers(chunksize):
+    sqls = ['select a from b', 'update c set d = 1', 'select e(f) from g']
+    stack = engine.FilterStack()
+    stack.enable_grouping()
+    serial = list(stack.run_many(sqls))
+    parallel = list(stack.run_many(sqls, workers=2, chunksize=chunksize))
+    assert [[str(s) for s in stmts] for stmts in parallel] == [
+        [str(s) for s in stmts] for stmts in serial]
+    assert isinstance(parallel[2][0].tokens[2], sql.Function)
+
+
+@needs_pool
+def test_run_many_with_workers_deeply_nested():
+    # too deep to pickle, the source is processed again in this process
+    s = 'select {0}a{1}'.format('(' * 300, ')' * 300)
+    stack = engine.FilterStack()
+    stack.enable_grouping()
+    deep, flat = stack.run_many([s, 'select b'], workers=2)
+    assert str(deep[0]) == s
+    assert str(flat[0]) == 'select b'
+
+
+def test_stmt_to_json():
+    stmt = bsqlparse.parse('select a from b')[0]
+    data = stmt.toJson()
+    assert sorted(data) == ['is_group', 'is_keyword', 'is_whitespace',
+                            'normalized', 'tokens', 'ttype', 'value']
+    assert data['value'] == 'select a from b'
+    assert data['tokens'][0] == {'value': 'select', 'ttype': T.Keyword.DML,
+                                 'normalized': 'SELECT', 'is_keyword': True,
+                                 'is_group': False, 'is_whitespace': False}
+
+
 @pytest.mark.parametrize('sql, is_literal', [
     ('$$foo$$', True),
     ('$_$foo$_$', True),
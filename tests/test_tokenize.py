@@ -81,6 +81,11 @@ def test_token_repr():
     assert repr(token)[:len(tst)] == tst
 
 
+def test_token_normalized_keyword():
+    assert sql.Token(T.Keyword, 'select').normalized == 'SELECT'
+    assert sql.Token(T.Name, 'select').normalized == 'select'
+
+
 def test_token_flatten():
     token = sql.Token(T.Keyword, 'foo')
     gen = token.flatten()